@@ -0,0 +1,288 @@
+"""
+Times each stage of the surveyhelper pipeline on a synthetic survey:
+import, parse, codebook, remove_html, load, tally, crosstab,
+significance and render. Each stage is timed as the best of --repeat
+runs, then run once more under tracemalloc for its peak memory.
+
+    python benchmarks/run_benchmarks.py --rows 200000
+    python benchmarks/run_benchmarks.py --save-baseline benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --baseline benchmarks/baseline.json
+
+With a baseline (recorded at the same survey size), every stage whose
+time or peak memory grew by more than --tolerance, and by at least
+MIN_REGRESSION_SECONDS or MIN_REGRESSION_MB, is reported as a
+regression and the exit status is 1. The cold import time is checked
+against IMPORT_BUDGET_SECONDS whether or not there is a baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import shutil
+import tempfile
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import numpy as np
+import surveyhelper as sh
+from surveyhelper.qsf_parser import _strip_html
+from surveyhelper.significance import compare_means, chisquare_by_choice
+from surveyhelper.tally import count_moments
+from synthetic import write_qsf, write_responses
+
+# Cold `import surveyhelper` must finish within this many seconds
+IMPORT_BUDGET_SECONDS = 0.1
+
+# A stage must also be this many seconds slower than the baseline to
+# count as a regression, so timer noise on very short stages is ignored
+MIN_REGRESSION_SECONDS = 0.01
+
+# Likewise, peak memory must grow by at least this many MB, so stages
+# that allocate almost nothing are not flagged for a few KB
+MIN_REGRESSION_MB = 1.0
+
+# Distinct HTML fragments stripped by the remove_html stage
+HTML_STRINGS = 20000
+
+def time_import(root):
+    """
+    Returns the time a cold import of the package takes in a fresh
+    interpreter
+    """
+    code = ("import time; t = time.perf_counter(); import surveyhelper; "
+            "print(time.perf_counter() - t)")
+    out = subprocess.run([sys.executable, "-c", code], cwd=root,
+                         capture_output=True, text=True, check=True)
+    return(float(out.stdout.strip().splitlines()[-1]))
+
+def parse(ctx):
+    ctx['parser'] = sh.QsfParser(ctx['qsf_file'])
+    return(len(ctx['parser'].qsf['SurveyElements']))
+
+def codebook(ctx):
+    _strip_html.cache_clear()
+    ctx['codebook'] = ctx['parser'].create_codebook()
+    return(len(ctx['codebook'].get_questions()))
+
+def remove_html(ctx):
+    _strip_html.cache_clear()
+    for s in ctx['html']:
+        sh.QsfParser.remove_html(s)
+    return(len(ctx['html']))
+
+def load(ctx):
+    ctx['responses'] = sh.ResponseSet(ctx['response_file'], ctx['codebook'])
+    return(len(ctx['responses']))
+
+def tally(ctx):
+    r = ctx['responses']
+    r.clear_tally_cache()
+    for q in r.get_select_questions():
+        q.tally(r)
+    return(len(r))
+
+def crosstab(ctx):
+    r = ctx['responses']
+    r.clear_tally_cache()
+    ctx['banner'] = r.banner(r.matched_questions, [ctx['cut_question']])
+    return(len(r))
+
+def significance(ctx):
+    tests = 0
+    for n, s, ss in ctx['moments']:
+        compare_means(n, s, ss)
+        tests += 1
+    for cts, resp in ctx['choice_counts']:
+        chisquare_by_choice(cts, resp)
+        tests += 1
+    return(tests)
+
+def render(ctx):
+    ctx['report'].create_report()
+    return(len(ctx['report'].response_set.matched_questions))
+
+def choose_cut(ctx):
+    ctx['cut_question'] = next(q for q in ctx['codebook'].get_questions()
+                               if isinstance(q, sh.SelectOneQuestion))
+
+def prepare_significance(ctx):
+    """
+    Collects the group sufficient statistics the significance stage
+    tests, one set per question cut by the cut question
+    """
+    r = ctx['responses']
+    codes, keys = r.factorize_cut(ctx['cut_question'])
+    ctx['moments'] = []
+    ctx['choice_counts'] = []
+    for q in r.get_select_questions():
+        if isinstance(q, sh.SelectOneQuestion):
+            cts = r.count_by_group(q, codes, len(keys))
+            ctx['moments'].append(count_moments(cts,
+                                                q.scale.get_values(True)))
+        else:
+            ctx['choice_counts'].append(r.count_by_group(q, codes, len(keys)))
+
+def prepare_report(ctx):
+    config_file = os.path.join(ctx['work_dir'], 'config.yml')
+    with open(config_file, 'w') as f:
+        f.write("output:\n"
+                "  template_dir: {}\n"
+                "  template_file: d3_frequency_report.html\n"
+                "  report_file: {}\n"
+                "analysis:\n"
+                "  cut_variable: {}\n"
+                "report_data:\n"
+                "  title: Benchmark\n".format(
+                os.path.join(ctx['root'], 'templates', 'd3'),
+                os.path.join(ctx['work_dir'], 'report.html'),
+                ctx['cut_question'].label))
+    r = ctx['responses']
+    # The report template has no chart for select multiple matrices
+    r.matched_questions = [q for q in r.matched_questions
+                           if hasattr(q, 'graph_type')]
+    ctx['report'] = sh.FrequencyReport(r, config_file)
+
+# (name, function, unit of the count it returns, setup run before it)
+STAGES = [
+    ('parse', parse, 'elements', None),
+    ('codebook', codebook, 'questions', None),
+    ('remove_html', remove_html, 'strings', None),
+    ('load', load, 'rows', choose_cut),
+    ('tally', tally, 'rows', None),
+    ('crosstab', crosstab, 'rows', None),
+    ('significance', significance, 'tests', prepare_significance),
+    ('render', render, 'questions', prepare_report),
+]
+
+def run_stage(fn, ctx, repeat):
+    """
+    Returns (best seconds, items, peak bytes) for one stage
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        items = fn(ctx)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    tracemalloc.start()
+    fn(ctx)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return(best, items, peak)
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='surveyhelper_bench_')
+    try:
+        return(run_in(args, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def run_in(args, work_dir):
+    root = os.path.dirname(HERE)
+    ctx = {'root': root, 'work_dir': work_dir,
+           'qsf_file': os.path.join(work_dir, 'survey.qsf'),
+           'response_file': os.path.join(work_dir, 'responses.csv'),
+           'html': ['<p><b>Item {}</b>&nbsp;text &amp; more</p>'.format(i)
+                    for i in range(HTML_STRINGS)]}
+    write_qsf(ctx['qsf_file'], args.questions, args.matrix_rows, args.choices)
+    write_responses(ctx['response_file'],
+                    sh.QsfParser(ctx['qsf_file']).create_codebook(),
+                    args.rows, args.seed)
+
+    # The import is timed in fresh interpreters, so it has no peak
+    # memory here
+    results = [('import', statistics.median(
+                time_import(root) for i in range(args.repeat)), 1, 0,
+                'imports')]
+    for name, fn, unit, setup in STAGES:
+        if setup is not None:
+            setup(ctx)
+        results.append((name,) + run_stage(fn, ctx, args.repeat) + (unit,))
+
+    stages = {}
+    for name, seconds, items, peak, unit in results:
+        stages[name] = {'seconds': seconds, 'items': items, 'unit': unit,
+                        'throughput': items / seconds if seconds > 0 else None,
+                        'peak_mb': peak / 2**20}
+        print("{:<13} {:>9.4f}s {:>12,.0f} {}/s {:>9.1f} MB peak".format(
+              name, seconds, stages[name]['throughput'] or 0, unit,
+              stages[name]['peak_mb']))
+    return({'params': {'questions': args.questions,
+                       'matrix_rows': args.matrix_rows,
+                       'choices': args.choices, 'rows': args.rows},
+            'machine': {'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'numpy': np.__version__},
+            'stages': stages})
+
+def compare(results, baseline, tolerance):
+    """
+    Prints each stage's time and peak memory relative to the baseline
+    and returns the names of the stages that regressed
+    """
+    if results['params'] != baseline['params']:
+        print("Baseline was recorded at a different size {}; not "
+              "comparing".format(baseline['params']))
+        return([])
+    regressed = []
+    print("\n{:<13} {:>10} {:>10}".format("stage", "time", "memory"))
+    for name, stage in results['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        base = baseline['stages'][name]
+        time_ratio = stage['seconds'] / base['seconds']
+        memory_ratio = (stage['peak_mb'] / base['peak_mb']
+                        if base['peak_mb'] > 0 else 1)
+        flag = ""
+        slower = (time_ratio > tolerance and 
+                  stage['seconds'] - base['seconds'] > MIN_REGRESSION_SECONDS)
+        larger = (memory_ratio > tolerance and
+                  stage['peak_mb'] - base['peak_mb'] > MIN_REGRESSION_MB)
+        if slower or larger:
+            regressed.append(name)
+            flag = "  REGRESSED"
+        print("{:<13} {:>9.2f}x {:>9.2f}x{}".format(name, time_ratio,
+                                                    memory_ratio, flag))
+    return(regressed)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--questions', type=int, default=40)
+    parser.add_argument('--matrix-rows', type=int, default=8)
+    parser.add_argument('--choices', type=int, default=5)
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', help="baseline results to compare with")
+    parser.add_argument('--save-baseline', help="write the results here")
+    parser.add_argument('--json', help="write the results here as well")
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help="largest acceptable ratio to the baseline")
+    args = parser.parse_args()
+
+    results = run(args)
+    for path in [args.save_baseline, args.json]:
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    failed = []
+    if results['stages']['import']['seconds'] > IMPORT_BUDGET_SECONDS:
+        print("\nImport took {:.3f}s, over the {}s budget".format(
+              results['stages']['import']['seconds'], IMPORT_BUDGET_SECONDS))
+        failed.append('import')
+    if args.baseline:
+        with open(args.baseline) as f:
+            failed += compare(results, json.load(f), args.tolerance)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Synthetic surveys for benchmarking. make_qsf builds a Qualtrics survey
+definition modeled on Sample_Survey.qsf (single and multiple answer
+questions, single and multiple answer matrices, recoded values,
+exclusions, HTML question text and matrices with dynamic choices piped
+from an earlier question), at any number of questions, matrix rows and
+choices. write_responses writes a matching Qualtrics-style response
+file of any number of rows.
+"""
+
+import json
+import numpy as np
+import pandas as pd
+from surveyhelper import SelectOneQuestion
+
+# The question types cycled through by make_qsf
+QUESTION_KINDS = ['single', 'multiple', 'matrix_single', 'matrix_multiple',
+                  'dynamic_matrix']
+
+def html_text(i, text):
+    """
+    Returns question or choice text wrapped in the kind of markup the
+    Qualtrics editor produces
+    """
+    return('<div><span style="font-size:14px;">{} <strong>{}</strong>'
+           '</span>&nbsp;&amp; more</div>'.format(text, i))
+
+def make_choices(n, label):
+    return(dict((str(k), {"Display": html_text(k, label)})
+               for k in range(1, n + 1)))
+
+def make_question(i, kind, matrix_rows, choices, source_qid):
+    """
+    Returns the Payload of survey element SQ for question number i
+    """
+    qid = "QID{}".format(i)
+    payload = {"QuestionID": qid, "DataExportTag": "Q{}".format(i),
+               "QuestionText": html_text(i, "Question"),
+               "QuestionDescription": "Question {}".format(i),
+               "Language": [], "Validation": {}, "Configuration": {}}
+    # Every third question stores its values reversed and excludes a
+    # choice from analysis, as Sample_Survey.qsf's Q4 does
+    recode = dict((str(k), str(choices + 1 - k))
+                  for k in range(1, choices + 1))
+    if kind in ('single', 'multiple'):
+        payload.update({"QuestionType": "MC",
+                        "Selector": "SAVR" if kind == 'single' else "MAVR",
+                        "SubSelector": "TX",
+                        "Choices": make_choices(choices, "Choice"),
+                        "ChoiceOrder": list(range(1, choices + 1))})
+    else:
+        rows = matrix_rows if kind != 'dynamic_matrix' else 1
+        payload.update({"QuestionType": "Matrix", "Selector": "Likert",
+                        "SubSelector": "MultipleAnswer"
+                        if kind == 'matrix_multiple' else "SingleAnswer",
+                        "Choices": make_choices(rows, "Statement"),
+                        "ChoiceOrder": [str(k) for k in range(1, rows + 1)],
+                        "Answers": make_choices(choices, "Answer"),
+                        "AnswerOrder": list(range(1, choices + 1)),
+                        "ChoiceDataExportTags": False})
+        if kind == 'dynamic_matrix' and source_qid is not None:
+            payload["DynamicChoices"] = {
+                "Locator": "q://{}/ChoiceGroup/SelectedChoices".format(
+                           source_qid)}
+    if i % 3 == 0:
+        payload["RecodeValues"] = recode
+        payload["AnalyzeChoices"] = {str(choices): "No"}
+    return(payload)
+
+def make_qsf(questions=40, matrix_rows=8, choices=5, title="Benchmark"):
+    """
+    Returns a survey definition (as would be parsed from a .qsf file)
+    with the given number of questions, rows per matrix and choices
+    per question
+    """
+    survey_id = "SV_benchmark"
+    elements = []
+    qids = []
+    source_qid = None
+    for i in range(1, questions + 1):
+        kind = QUESTION_KINDS[(i - 1) % len(QUESTION_KINDS)]
+        payload = make_question(i, kind, matrix_rows, choices, source_qid)
+        if kind == 'multiple':
+            source_qid = payload["QuestionID"]
+        qids.append(payload["QuestionID"])
+        elements.append({"SurveyID": survey_id, "Element": "SQ",
+                         "PrimaryAttribute": payload["QuestionID"],
+                         "SecondaryAttribute": payload["QuestionDescription"],
+                         "TertiaryAttribute": None, "Payload": payload})
+    blocks = [{"Type": "Default", "Description": "Default Question Block",
+               "ID": "BL_default",
+               "BlockElements": [{"Type": "Question", "QuestionID": q}
+                                 for q in qids]},
+              {"Type": "Trash", "Description": "Trash / Unused Questions",
+               "ID": "BL_trash"}]
+    elements.append({"SurveyID": survey_id, "Element": "BL",
+                     "PrimaryAttribute": "Survey Blocks",
+                     "SecondaryAttribute": None, "TertiaryAttribute": None,
+                     "Payload": blocks})
+    elements.append({"SurveyID": survey_id, "Element": "FL",
+                     "PrimaryAttribute": "Survey Flow",
+                     "SecondaryAttribute": None, "TertiaryAttribute": None,
+                     "Payload": {"Flow": [{"ID": "BL_default",
+                                           "Type": "Block",
+                                           "FlowID": "FL_2"}],
+                                 "Properties": {"Count": 2},
+                                 "FlowID": "FL_1", "Type": "Root"}})
+    return({"SurveyEntry": {"SurveyID": survey_id, "SurveyName": title},
+            "SurveyElements": elements})
+
+def write_qsf(path, questions=40, matrix_rows=8, choices=5):
+    with open(path, 'w') as f:
+        json.dump(make_qsf(questions, matrix_rows, choices), f)
+
+def write_responses(path, codebook, rows, seed=0, missing=0.1,
+                    selected=0.35):
+    """
+    Writes a Qualtrics-style response file (variable names, then a row
+    of labels, then one row per response) for every question in the
+    codebook. Each select one answer is missing with probability
+    missing; each select multiple choice is picked with probability
+    selected.
+    """
+    rng = np.random.default_rng(seed)
+    columns = {"ResponseID": ["R_{}".format(i) for i in range(rows)]}
+    for q in codebook.get_questions():
+        children = q.questions if hasattr(q, 'questions') else [q]
+        for child in children:
+            if isinstance(child, SelectOneQuestion):
+                values = np.array(child.scale.values, dtype=float)
+                answers = rng.choice(values, rows)
+                answers[rng.random(rows) < missing] = np.nan
+                columns[child.variable] = answers
+            else:
+                for v in child.variables:
+                    columns[v] = np.where(rng.random(rows) < selected,
+                                          1.0, np.nan)
+    df = pd.DataFrame(columns)
+    with open(path, 'w') as f:
+        f.write(",".join(df.columns) + "\n")
+        f.write(",".join(df.columns) + "\n")
+        df.to_csv(f, header=False, index=False, float_format="%.0f")
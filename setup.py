@@ -12,5 +12,6 @@ setup(name='surveyhelper',
 	  author_email="pysurveyhelper@gmail.com",
 	  license='MIT',
 	  packages=['surveyhelper'],
-	  install_requires=['beautifulsoup4', 'pandas', 'jinja2', 'unidecode'],
+	  install_requires=['pandas', 'jinja2>=2.9', 'unidecode'],
+	  extras_require={'cache': ['pyarrow']},
 	  zip_safe=False)
\ No newline at end of file
@@ -1,12 +1,53 @@
-from surveyhelper.question import *
-from surveyhelper.codebook import *
-from surveyhelper.qsf_parser import *
-from surveyhelper.response_set import *
-from surveyhelper.frequency_report import *
-from surveyhelper.scale import *
-
-import os
-import glob
-
-modules = glob.glob(os.path.dirname(__file__)+"/*.py")
-__all__ = [ os.path.basename(f)[:-3] for f in modules]
\ No newline at end of file
+"""
+The package's public names are imported from their modules on first
+use, so ``import surveyhelper`` stays cheap: pandas loads with the
+question classes, scipy with the first significance test, and jinja2
+with the first rendered report.
+"""
+
+import importlib
+
+_exports = {
+    'surveyhelper.question': ['MatrixQuestion', 'SelectOneMatrixQuestion',
+                              'SelectMultipleMatrixQuestion',
+                              'SelectQuestion', 'SelectOneQuestion',
+                              'SelectMultipleQuestion'],
+    'surveyhelper.codebook': ['Codebook'],
+    'surveyhelper.qsf_parser': ['QsfParser', 'CODEBOOK_CACHE_VERSION'],
+    'surveyhelper.response_set': ['ResponseSet', 'compact_int_dtype',
+                                  'READ_CHUNK_ROWS', 'DATA_CACHE_VERSION',
+                                  'STATE_VERSION'],
+    'surveyhelper.partitioned_response_set': ['PartitionedResponseSet'],
+    'surveyhelper.frequency_report': ['FrequencyReport', 'get_environment',
+                                      'REPORT_CHUNK_ITEMS',
+                                      'REPORT_WRITE_BUFFER'],
+    'surveyhelper.scale': ['QuestionScale', 'NominalScale', 'OrdinalScale',
+                           'LikertScale'],
+    'surveyhelper.profiling': ['Profiler', 'enable_profiling',
+                               'disable_profiling', 'get_profiler',
+                               'profile_stage'],
+}
+
+_modules = ['codebook', 'files', 'frequency_report',
+            'partitioned_response_set', 'profiling', 'qsf_parser',
+            'question', 'raking', 'response_set', 'scale', 'significance',
+            'tally']
+
+_locations = dict((name, module) for module, names in _exports.items()
+                  for name in names)
+
+__all__ = sorted(_locations) + _modules
+
+def __getattr__(name):
+    if name in _locations:
+        value = getattr(importlib.import_module(_locations[name]), name)
+    elif name in _modules:
+        value = importlib.import_module('surveyhelper.' + name)
+    else:
+        raise AttributeError("module 'surveyhelper' has no attribute "
+                             "'{}'".format(name))
+    globals()[name] = value
+    return(value)
+
+def __dir__():
+    return(sorted(set(globals()) | set(__all__)))
@@ -0,0 +1,49 @@
+"""
+Files
+-----
+Writing the codebook cache, the response cache and the incremental
+load state: each is written to a temporary file in the target's
+directory and moved into place, so concurrent jobs never see a
+partially written file.
+"""
+
+import os
+import tempfile
+from contextlib import contextmanager
+
+def get_umask():
+    """
+    Returns the process's umask, which can only be read by setting it
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return(umask)
+
+# Read once on import: setting the umask, even briefly, would race with
+# threads creating files, such as partitions loaded in a thread pool
+UMASK = get_umask()
+
+@contextmanager
+def atomic_write(path):
+    """
+    Yields a temporary path to write in place of path. When the block
+    finishes, the temporary file replaces path; if it raises, the
+    temporary file is removed and path is left as it was. The file is
+    given the permissions open() would create it with, so caches stay
+    readable by other users under the usual umask.
+
+        with atomic_write(cache_file) as tmp:
+            feather.write_feather(df, tmp)
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp
+        # mkstemp creates the file as 0600 whatever the umask
+        os.chmod(tmp, 0o666 & ~UMASK)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
@@ -4,31 +4,192 @@ FrequencyReport
 Provides utilities for producing a survey frequency report.
 """
 
-from jinja2 import Environment, FileSystemLoader
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import yaml
-from unidecode import unidecode
+from surveyhelper.profiling import profile_stage
+from surveyhelper.tally import row_weights, count_values_by_column
+
+# Template output pieces gathered into each chunk written to the report,
+# and the report file's write buffer size in bytes
+REPORT_CHUNK_ITEMS = 64
+REPORT_WRITE_BUFFER = 1 << 16
+
+# Jinja environments shared by every FrequencyReport in the process, 
+# keyed by (template directory, bytecode cache directory), and the 
+# templates already compiled in each
+_environments = {}
+_compiled = {}
+_environments_lock = threading.Lock()
+
+def get_environment(template_dir, bytecode_cache_dir=None, 
+                    template_file=None):
+    """
+    Returns the shared Jinja Environment for template_dir, creating it
+    on first use. If template_file is given, it is compiled along with
+    every template it includes, extends or imports; other files in the
+    directory are never read. Compiled templates are also kept in a 
+    bytecode cache on disk (bytecode_cache_dir, or a per-user directory
+    under the system temp directory), so later processes skip compiling
+    them.
+    """
+    from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+    key = (os.path.abspath(template_dir), bytecode_cache_dir)
+    with _environments_lock:
+        if key not in _environments:
+            if bytecode_cache_dir is not None:
+                os.makedirs(bytecode_cache_dir, exist_ok=True)
+            _environments[key] = Environment(
+                loader=FileSystemLoader(template_dir),
+                bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dir))
+            _compiled[key] = set()
+        env = _environments[key]
+        if template_file is not None:
+            compile_templates(env, template_file, _compiled[key])
+        return(env)
+
+def compile_templates(env, name, compiled):
+    """
+    Compiles template name and, in turn, each template it refers to by
+    a constant name, skipping those in compiled and adding the rest.
+    Templates named by a variable are compiled when first rendered.
+    """
+    from jinja2 import meta
+    pending = [name]
+    while pending:
+        name = pending.pop()
+        if name in compiled:
+            continue
+        env.get_template(name)
+        compiled.add(name)
+        source = env.loader.get_source(env, name)[0]
+        pending += [r for r in meta.find_referenced_templates(env.parse(source))
+                    if r is not None]
+
+class _WeightedColumns:
+    """
+    Stands in for a weighted ResponseSet in a worker process, which 
+    receives only one question's columns and the weight column
+    """
+
+    def __init__(self, df, weight_variable):
+        self.data = df
+        self.weights = row_weights(df, weight_variable)
+        self.tallies = {}
+
+    def tally(self, question, remove_exclusions=True):
+        key = frozenset(question.get_variable_names())
+        if key not in self.tallies:
+            self.tallies[key] = question.accumulate(self.data, self.weights)
+        return(question.tally_summary(self.tallies[key], remove_exclusions))
+
+    def get_cached_matrix_counts(self, question, remove_exclusions=True):
+        return(count_values_by_column(self.data, 
+            question.get_variable_names(),
+            question.get_scale().get_values(remove_exclusions), self.weights))
+
+def _freq_table_to_json(question, df, weight_variable=None):
+    """
+    Worker for parallel report generation; df holds only the question's
+    own columns, plus the weight column for weighted data
+    """
+    if weight_variable is not None:
+        df = _WeightedColumns(df, weight_variable)
+    return(question.freq_table_to_json(df))
 
 class FrequencyReport:
 
     def __init__(self, response_set, config_file):
         with open(config_file, 'r') as ymlfile:
-            cfg = yaml.load(ymlfile)
+            cfg = yaml.safe_load(ymlfile)
 
         self.template_dir = cfg['output']['template_dir']
         self.freq_template = cfg['output']['template_file']
         self.report_file = cfg['output']['report_file']
         self.cut_var = cfg['analysis']['cut_variable']
         self.report_title = cfg['report_data']['title']
+        self.bytecode_cache_dir = cfg['output'].get('bytecode_cache_dir')
+        # Optional parallelism for the per-question aggregation. workers
+        # of 1 (the default) computes serially; executor is 'process' or
+        # 'thread' (threads suit NumPy-bound work and share the 
+        # ResponseSet's tally cache)
+        self.workers = cfg['analysis'].get('workers', 1)
+        self.executor = cfg['analysis'].get('executor', 'process')
         self.response_set = response_set
 
+    def question_json(self, question):
+        with profile_stage('freq_table_to_json', question.label,
+                           len(self.response_set)):
+            return(question.freq_table_to_json(self.response_set))
+
+    def get_frequency_json(self):
+        """
+        Returns the frequency JSON of each matched question, in the
+        order of response_set.matched_questions
+        """
+        questions = self.response_set.matched_questions
+        data = self.response_set.data
+        if self.workers <= 1 or data is None:
+            return([self.question_json(q) for q in questions])
+        if self.executor == 'thread':
+            with ThreadPoolExecutor(self.workers) as pool:
+                return(list(pool.map(self.question_json, questions)))
+        elif self.executor == 'process':
+            # Send each worker only the columns its question needs rather
+            # than the whole response frame; questions whose columns are
+            # not in the frame (e.g. bit-packed) are cheap and run here
+            pooled = [all(v in data for v in q.get_variable_names()) 
+                      for q in questions]
+            weight_variable = self.response_set.weight_variable
+            extra = [weight_variable] if weight_variable is not None else []
+            columns = (data[q.get_variable_names() + extra] 
+                       for q, p in zip(questions, pooled) if p)
+            tasks = [q for q, p in zip(questions, pooled) if p]
+            # Worker processes are not profiled, so the pool is timed
+            # as one stage
+            with profile_stage('frequency_json_pool', 
+                               rows=len(self.response_set)):
+                with ProcessPoolExecutor(self.workers) as pool:
+                    results = iter(list(pool.map(_freq_table_to_json, 
+                                   tasks, columns, 
+                                   [weight_variable]*len(tasks))))
+            return([next(results) if p else self.question_json(q)
+                    for q, p in zip(questions, pooled)])
+        else:
+            raise(Exception("Invalid executor: {}".format(self.executor)))
+
     def create_report(self):
-        env = Environment(loader=FileSystemLoader(self.template_dir),
-                  extensions=['jinja2.ext.with_'])
-        template = env.get_template(self.freq_template)
-        outfile = open(self.report_file, 'w+')
-        
+        """
+        Renders the report to report_file. The template is streamed, so
+        the rendered report is transliterated and written a chunk at a
+        time and never held in memory whole.
+        """
+        from unidecode import unidecode
+        with profile_stage('create_report', rows=len(self.response_set)):
+            env = get_environment(self.template_dir, self.bytecode_cache_dir,
+                                  self.freq_template)
+            template = env.get_template(self.freq_template)
+            with profile_stage('report_questions'):
+                questions = self.get_report_questions()
+            with profile_stage('render'):
+                stream = template.stream(count=len(self.response_set),
+                                         survey_title=self.report_title,
+                                         questions=questions)
+                stream.enable_buffering(REPORT_CHUNK_ITEMS)
+                with open(self.report_file, 'w', 
+                          buffering=REPORT_WRITE_BUFFER) as outfile:
+                    for chunk in stream:
+                        outfile.write(unidecode(chunk))
+
+    def get_report_questions(self):
+        """
+        Returns the per-question tuples the report template iterates
+        over
+        """
         questions = []
-        for q in self.response_set.matched_questions:
+        for q, freq_json in zip(self.response_set.matched_questions,
+                                self.get_frequency_json()):
             scale = q.get_scale()
             if scale and hasattr(scale, 'midpoint'):
                 midpoint = scale.midpoint
@@ -36,15 +197,12 @@ class FrequencyReport:
                 midpoint = None
             questions.append((
                             q.text,
-                            q.freq_table_to_json(self.response_set.data),
-                            [q.freq_table_to_json(self.response_set.data)],
+                            freq_json,
+                            [freq_json],
                             q.questions_to_json(),
                             ['all'],
                             q.graph_type(),
                             midpoint
                             ))
-        t = template.render(count=len(self.response_set.data),
-                                      survey_title=self.report_title,
-                                      questions=questions)
-        outfile.write(unidecode(t))
+        return(questions)
 
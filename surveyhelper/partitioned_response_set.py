@@ -0,0 +1,313 @@
+"""
+PartitionedResponseSet
+--------
+Responses to one survey spread over several response files (waves,
+markets, ...), analysed together without concatenating them. Each file
+is loaded as its own ResponseSet, and tallies and group counts are
+combined by adding the partitions'. A PartitionedResponseSet provides
+the part of the ResponseSet interface that questions, banners and
+FrequencyReport use; operations on the rows themselves (weighting,
+raking, grouping) are done on each partition.
+"""
+
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from surveyhelper.question import SelectOneQuestion, SelectMultipleQuestion
+from surveyhelper.response_set import ResponseSet, select_questions, \
+build_banner
+from surveyhelper.tally import effective_sizes
+from surveyhelper.profiling import profile_stage
+
+def _load_partition(response_file, codebook, options):
+    """
+    Worker for parallel loading; loads one partition and tallies its
+    questions, so the tallies are computed in the worker as well
+    """
+    response_set = ResponseSet(response_file, codebook, **options)
+    if response_set.data is not None:
+        for q in response_set.get_select_questions():
+            response_set.get_summary(q)
+    return(response_set)
+
+class PartitionedResponseSet:
+
+    def __init__(self, response_files, codebook, partition_variable="partition",
+                 workers=1, executor='process', **options):
+        """
+        Loads each of response_files as a partition bound to codebook.
+        response_files maps each partition key (e.g. a wave or market)
+        to its response file; a list of files is keyed by file name.
+        options are passed to every partition's ResponseSet (e.g.
+        streaming, cache_dir or weight_variable).
+
+        With workers > 1 the partitions are loaded, and their questions
+        tallied, in parallel: executor is 'process' or 'thread', as for
+        FrequencyReport. Processes suit streamed partitions best, since
+        in-memory partitions are copied back whole.
+
+        The set can be passed in place of a ResponseSet to tally, mean,
+        frequency_table, cut_by_question and cooccurrence, and to 
+        FrequencyReport: tallies add up the partitions' tallies, and
+        cuts, banner and cooccurrence add up their group counts. To
+        weight, rake or filter rows, do so on each of self.partitions
+        (then call clear_tally_cache).
+
+        partition_question, a select one question whose choices are the
+        partition keys, cuts by partition; banner also accepts
+        partition_variable as its label. Cuts by partition work from the
+        tallies alone, but cuts by other questions need the partitions'
+        data, so are not available when streaming.
+        """
+        if 'state_file' in options:
+            raise(Exception("Partitions cannot share a state_file"))
+        if not isinstance(response_files, dict):
+            response_files = OrderedDict((os.path.basename(f), f)
+                                         for f in response_files)
+        keys = list(response_files)
+        files = [response_files[k] for k in keys]
+        codebooks = [codebook]*len(files)
+        option_list = [options]*len(files)
+        with profile_stage('load_partitions') as stage:
+            if workers <= 1:
+                loaded = list(map(_load_partition, files, codebooks,
+                                  option_list))
+            elif executor == 'thread':
+                with ThreadPoolExecutor(workers) as pool:
+                    loaded = list(pool.map(_load_partition, files, codebooks,
+                                           option_list))
+            elif executor == 'process':
+                with ProcessPoolExecutor(workers) as pool:
+                    loaded = list(pool.map(_load_partition, files, codebooks,
+                                           option_list))
+            else:
+                raise(Exception("Invalid executor: {}".format(executor)))
+            self.partitions = OrderedDict(zip(keys, loaded))
+            self.row_count = sum(len(p) for p in loaded)
+            stage.rows = self.row_count
+
+        # Only questions found in every partition are analysed
+        matched = set.intersection(*[set(q.label for q in p.matched_questions)
+                                     for p in loaded]) if loaded else set()
+        self.matched_questions = [q for q in codebook.get_questions()
+                                  if q.label in matched]
+        self.codebook = codebook
+        self.cut_cache = {}
+        # there is no single frame of responses, so questions are 
+        # counted from the partitions' tallies
+        self.data = None
+        self.weights = None
+        self.weight_variable = options.get('weight_variable')
+        self.partition_variable = partition_variable
+        self.partition_question = SelectOneQuestion(partition_variable,
+            partition_variable, [str(k) for k in keys], partition_variable,
+            list(range(1, len(keys)+1)), [False]*len(keys),
+            scale_type='ordinal')
+
+    def __len__(self):
+        return(self.row_count)
+
+    def get_question(self, label):
+        if label == self.partition_variable:
+            return(self.partition_question)
+        return(self.codebook.get_question(label))
+
+    def get_select_questions(self):
+        """
+        Returns the matched questions with matrix questions replaced by
+        their rows
+        """
+        return(select_questions(self.matched_questions))
+
+    def tally(self, question, remove_exclusions=True, rows=None):
+        """
+        Returns question's (frequencies, respondents, nonrespondents)
+        tuple over all the partitions
+        """
+        summary = self.get_summary(question, rows)
+        return(question.tally_summary(summary, remove_exclusions))
+
+    def effective_sample_size(self, question, remove_exclusions=True, 
+                              rows=None):
+        summary = self.get_summary(question, rows)
+        return(summary.effective_size(remove_exclusions))
+
+    def get_summary(self, question, rows=None):
+        """
+        Returns the sum of the partitions' Tallies of question
+        """
+        if rows is not None:
+            raise(Exception("Row subsets are not available for partitioned responses"))
+        summaries = [p.get_summary(question) for p in self.partitions.values()]
+        return(sum(summaries[1:], summaries[0]))
+
+    def clear_tally_cache(self):
+        """
+        Discards all memoized tallies and cut factorizations; call after
+        modifying a partition
+        """
+        for p in self.partitions.values():
+            p.clear_tally_cache()
+        self.cut_cache = {}
+
+    def factorize_cut(self, cut_question, remove_exclusions=True):
+        """
+        Returns (codes, keys) as for ResponseSet, except that codes has
+        an entry per partition: either an array of its rows' group
+        codes, or, when cutting by partition, the partition's group
+        (-1 for an empty partition).
+        """
+        key = (cut_question.variable, cut_question.scale.signature(),
+               remove_exclusions)
+        if key not in self.cut_cache:
+            if cut_question is self.partition_question:
+                self.cut_cache[key] = self.factorize_partitions()
+            else:
+                self.cut_cache[key] = self._factorize_cut(cut_question,
+                                                          remove_exclusions)
+        return(self.cut_cache[key])
+
+    def factorize_partitions(self):
+        values = self.partition_question.scale.values
+        present = [len(p) > 0 for p in self.partitions.values()]
+        position = np.cumsum(present) - 1
+        codes = [int(i) if p else -1 for i, p in zip(position, present)]
+        return(codes, [v for v, p in zip(values, present) if p])
+
+    def _factorize_cut(self, cut_question, remove_exclusions):
+        factors = []
+        for p in self.partitions.values():
+            if p.data is None:
+                raise(Exception("Cuts by {} are not available when streaming".format(
+                                cut_question.label)))
+            factors.append(p.factorize_cut(cut_question, remove_exclusions))
+        # Each partition's keys are the values present in it; recode
+        # them to the values present in any partition
+        found = set(k for codes, keys in factors for k in keys)
+        keys = [v for v in cut_question.scale.get_values(remove_exclusions)
+                if v in found]
+        position = dict((k, i) for i, k in enumerate(keys))
+        codes = []
+        for part_codes, part_keys in factors:
+            # a code of -1 picks the trailing -1
+            lookup = np.array([position[k] for k in part_keys] + [-1])
+            codes.append(lookup[part_codes])
+        return(codes, keys)
+
+    def count_by_group(self, question, codes, n_groups, remove_exclusions=True):
+        """
+        Returns question.count_by_group summed over the partitions,
+        given codes from factorize_cut
+        """
+        total = None
+        for p, part_codes in zip(self.partitions.values(), codes):
+            if isinstance(part_codes, int):
+                cts = PartitionedResponseSet.count_partition(p, question,
+                      part_codes, n_groups, remove_exclusions)
+            else:
+                cts = p.count_by_group(question, part_codes, n_groups,
+                                       remove_exclusions)
+            if total is None:
+                total = cts
+            elif isinstance(question, SelectMultipleQuestion):
+                total = (total[0] + cts[0], total[1] + cts[1])
+            else:
+                total = total + cts
+        return(total)
+
+    @staticmethod
+    def count_partition(partition, question, group, n_groups,
+                        remove_exclusions=True):
+        """
+        Returns count_by_group's result for a partition whose rows all
+        belong to group, from its Tally
+        """
+        summary = partition.get_summary(question)
+        if isinstance(question, SelectMultipleQuestion):
+            keys = question.get_tally_variables(remove_exclusions)
+        else:
+            keys = question.scale.get_values(remove_exclusions)
+        cts = np.zeros((n_groups, len(keys)), dtype=summary.counts.dtype)
+        resp = np.zeros(n_groups, dtype=summary.counts.dtype)
+        if group >= 0:
+            cts[group] = summary.get_counts(keys)
+            resp[group] = summary.respondents[remove_exclusions]
+        if isinstance(question, SelectMultipleQuestion):
+            return((cts, resp))
+        return(cts)
+
+    def group_effective_sizes(self, question, codes, n_groups,
+                              remove_exclusions=True):
+        """
+        Returns the effective sample size of question's respondents in
+        each group, or None when the partitions are unweighted
+        """
+        if not self.is_weighted():
+            return(None)
+        totals = np.zeros(n_groups)
+        sumsq = np.zeros(n_groups)
+        for p, part_codes in zip(self.partitions.values(), codes):
+            if isinstance(part_codes, int):
+                if part_codes >= 0:
+                    summary = p.get_summary(question)
+                    totals[part_codes] += summary.respondents[remove_exclusions]
+                    sumsq[part_codes] += summary.sumsq[remove_exclusions]
+                continue
+            cts = p.count_by_group(question, part_codes, n_groups,
+                                   remove_exclusions)
+            # an unweighted partition's squared weights are its counts
+            sq = cts
+            if p.weights is not None:
+                sq = p.count_by_group(question, part_codes, n_groups,
+                                      remove_exclusions, p.weights**2)
+            if isinstance(question, SelectMultipleQuestion):
+                totals += cts[1]
+                sumsq += sq[1]
+            else:
+                totals += cts.sum(axis=1)
+                sumsq += sq.sum(axis=1)
+        return(effective_sizes(totals, sumsq))
+
+    def is_weighted(self):
+        """
+        Whether any partition is weighted, checked on each call since
+        the partitions may be weighted or raked after loading
+        """
+        return(any(p.weights is not None for p in self.partitions.values()))
+
+    def cooccurrence(self, question, remove_exclusions=True):
+        """
+        Returns the partitions' cooccurrence counts, summed
+        """
+        for p in self.partitions.values():
+            if p.data is None:
+                raise(Exception("Cooccurrence is not available when streaming"))
+        return(sum(p.cooccurrence(question, remove_exclusions)
+                   for p in self.partitions.values()))
+
+    def banner(self, questions, cut_questions, pct_format=".0%",
+               remove_exclusions=True, show_mean=True, mean_format=".1f"):
+        """
+        Returns ResponseSet.banner's tables for the partitioned
+        responses; cut_questions may include partition_variable
+        """
+        questions = [self.get_question(q) if isinstance(q, str) else q
+                     for q in questions]
+        cuts = [self.get_question(q) if isinstance(q, str) else q
+                for q in cut_questions]
+        tables = build_banner(self, questions, cuts, remove_exclusions, 
+                              show_mean)
+        return([t.to_frame(pct_format, mean_format) for t in tables])
+
+    def group_counter(self, question, remove_exclusions=True):
+        """
+        Returns a function of (codes, n_groups) giving question's group
+        counts and effective sizes for a cut, as for ResponseSet
+        """
+        def count(codes, n_groups):
+            return(self.count_by_group(question, codes, n_groups,
+                                       remove_exclusions),
+                   self.group_effective_sizes(question, codes, n_groups,
+                                              remove_exclusions))
+        return(count)
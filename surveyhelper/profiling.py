@@ -0,0 +1,196 @@
+"""
+Profiling
+---------
+Opt-in timing of the pipeline's stages. Once enable_profiling has been
+called, each instrumented stage (parsing the qsf, building each
+question, loading responses, tallying, each question's frequency JSON,
+rendering the report, ...) is recorded with its wall and CPU time, the
+rows it processed and, optionally, its memory use. While profiling is
+disabled, profile_stage returns a shared do-nothing stage, so the
+instrumentation costs one function call per stage.
+
+    profiler = sh.enable_profiling()
+    f.create_report()
+    profiler.to_csv("profile.csv")
+"""
+
+import csv
+import io
+import json
+import threading
+import time
+import tracemalloc
+
+# Columns of each record, in the order written by to_csv
+RECORD_FIELDS = ['stage', 'question', 'rows', 'depth', 'parent',
+                 'wall_seconds', 'cpu_seconds', 'memory_delta_bytes',
+                 'memory_peak_bytes']
+
+_profiler = None
+
+class _NullStage:
+    """
+    Stage returned while profiling is disabled; ignores everything
+    """
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        return(False)
+
+    def __setattr__(self, name, value):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class Stage:
+    """
+    One timed stage. rows may be set inside the with block once the
+    number of rows processed is known.
+    """
+
+    def __init__(self, profiler, name, question, rows):
+        self.profiler = profiler
+        self.name = name
+        self.question = question
+        self.rows = rows
+        self.child_peak = 0
+
+    def __enter__(self):
+        self.stack = self.profiler.get_stack()
+        self.parent = self.stack[-1].name if self.stack else None
+        self.depth = len(self.stack)
+        if self.profiler.memory:
+            # tracemalloc has a single peak, which each stage resets, so
+            # the enclosing stage keeps the peak reached so far itself
+            self.memory_start, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                outer = self.stack[-1]
+                outer.child_peak = max(outer.child_peak, peak)
+            tracemalloc.reset_peak()
+        self.stack.append(self)
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return(self)
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        self.stack.pop()
+        record = {'stage': self.name, 'question': self.question,
+                  'rows': self.rows, 'depth': self.depth,
+                  'parent': self.parent, 'wall_seconds': wall,
+                  'cpu_seconds': cpu, 'memory_delta_bytes': None,
+                  'memory_peak_bytes': None}
+        if self.profiler.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, self.child_peak)
+            record['memory_delta_bytes'] = current - self.memory_start
+            record['memory_peak_bytes'] = peak - self.memory_start
+            if self.stack:
+                outer = self.stack[-1]
+                outer.child_peak = max(outer.child_peak, peak)
+        self.profiler.add_record(record)
+        return(False)
+
+class Profiler:
+    """
+    Collects a record of every profiled stage. callback, if given, is
+    called with each record (a dict with the RECORD_FIELDS keys) as its
+    stage finishes. With memory=True, tracemalloc is started to measure
+    each stage's memory delta and peak, which slows allocation-heavy
+    code noticeably; memory is process-wide, so stages running in 
+    parallel threads see each other's allocations.
+    """
+
+    def __init__(self, callback=None, memory=False):
+        self.callback = callback
+        self.memory = memory
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started_tracemalloc = False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+    def get_stack(self):
+        """
+        Returns the stages currently open in this thread
+        """
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return(self.local.stack)
+
+    def stage(self, name, question=None, rows=None):
+        return(Stage(self, name, question, rows))
+
+    def add_record(self, record):
+        with self.lock:
+            self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def close(self):
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def to_json(self, path=None):
+        """
+        Returns the records as a JSON string, or writes them to path
+        """
+        if path is None:
+            return(json.dumps(self.records, indent=2))
+        with open(path, 'w') as f:
+            json.dump(self.records, f, indent=2)
+
+    def to_csv(self, path=None):
+        """
+        Returns the records as CSV text, or writes them to path
+        """
+        if path is None:
+            out = io.StringIO()
+            self.write_csv(out)
+            return(out.getvalue())
+        with open(path, 'w', newline='') as f:
+            self.write_csv(f)
+
+    def write_csv(self, f):
+        writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS)
+        writer.writeheader()
+        writer.writerows(self.records)
+
+def enable_profiling(callback=None, memory=False):
+    """
+    Starts recording every profiled stage and returns the Profiler
+    holding the records
+    """
+    global _profiler
+    disable_profiling()
+    _profiler = Profiler(callback, memory)
+    return(_profiler)
+
+def disable_profiling():
+    """
+    Stops recording; returns the Profiler that was active, if any
+    """
+    global _profiler
+    profiler = _profiler
+    _profiler = None
+    if profiler is not None:
+        profiler.close()
+    return(profiler)
+
+def get_profiler():
+    return(_profiler)
+
+def profile_stage(name, question=None, rows=None):
+    """
+    Returns a context manager timing the stage name (for question, if
+    given, over rows rows) when profiling is enabled
+    """
+    if _profiler is None:
+        return(_NULL_STAGE)
+    return(_profiler.stage(name, question, rows))
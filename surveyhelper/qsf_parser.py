@@ -4,31 +4,141 @@ Parses a Qualtrics .qsf file and creates a codebook from it.
 
 import json
 import re
+import os
+import hashlib
+import pickle
 import logging
+from functools import lru_cache
+from html.parser import HTMLParser
 from pprint import pprint
-from bs4 import BeautifulSoup
-from surveyhelper import SelectOneQuestion, SelectMultipleQuestion, \
-SelectOneMatrixQuestion, SelectMultipleMatrixQuestion, Codebook
+from surveyhelper.question import SelectOneQuestion, SelectMultipleQuestion, \
+SelectOneMatrixQuestion, SelectMultipleMatrixQuestion
+from surveyhelper.codebook import Codebook
+from surveyhelper.profiling import profile_stage
+from surveyhelper.files import atomic_write
+
+# Bump whenever the question, scale or codebook classes change in a way
+# that makes previously pickled codebooks stale.
+CODEBOOK_CACHE_VERSION = 1
+
+class _TextExtractor(HTMLParser):
+    """
+    Collects the text content of an HTML fragment, skipping anything
+    inside <style> or <script> tags.
+    """
+    skip_tags = ('style', 'script')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip_tags:
+            self.skip_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.skip_tags and self.skip_depth > 0:
+            self.skip_depth -= 1
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+@lru_cache(maxsize=4096)
+def _strip_html(text):
+    if '<' not in text and '&' not in text:
+        return(text.strip())
+    parser = _TextExtractor()
+    parser.feed(text)
+    parser.close()
+    return(''.join(parser.parts).strip())
 
 class QsfParser:
 
     def __init__(self, qsf_filename, options = {'exclude_trash': True}):
-        with open(qsf_filename) as qsf_file:
-            qsf = json.load(qsf_file)
-        self.qsf = qsf
-        self.options = options
+        with profile_stage('parse_qsf'):
+            with open(qsf_filename, 'rb') as qsf_file:
+                raw = qsf_file.read()
+            self.qsf = json.loads(raw)
+            self.qsf_hash = hashlib.sha256(raw).hexdigest()
+            self.options = options
+            self.index_survey_elements()
+
+    def index_survey_elements(self):
+        """
+        Builds the lookups used by the other methods: survey elements
+        grouped by element type, and question elements by QuestionID
+        """
+        self.elements_by_type = {}
+        self.questions_by_id = {}
+        for e in self.qsf['SurveyElements']:
+            self.elements_by_type.setdefault(e['Element'], []).append(e)
+            if e['Element'] == 'SQ':
+                self.questions_by_id[e['Payload']['QuestionID']] = e
+
+    def get_elements(self, element_type):
+        """
+        Returns the list of survey elements of the given type, e.g. 'SQ'
+        """
+        return(self.elements_by_type.get(element_type, []))
 
     @staticmethod
     def remove_html(text):
-        soup = BeautifulSoup(text)
-        [s.extract() for s in soup('style')]
-        return(soup.get_text().strip())
+        """
+        Returns the text content of an HTML fragment. Results are
+        memoized, since answer scales repeat across matrix rows.
+        """
+        return(_strip_html(text))
 
-    def create_codebook(self, title = None):
-        q = self.create_questions()
+    def create_codebook(self, title = None, cache_dir = None):
+        """
+        Builds a Codebook from the parsed qsf. If cache_dir is given, the
+        built codebook is pickled there and reused by later calls on the
+        same qsf content and parser options.
+        """
         if title == None:
             title = self.get_survey_title()
-        return(Codebook(title, q))
+        if cache_dir is not None:
+            cache_file = self.get_codebook_cache_file(cache_dir, title)
+            codebook = QsfParser.load_cached_codebook(cache_file)
+            if codebook is not None:
+                return(codebook)
+        with profile_stage('create_questions'):
+            q = self.create_questions()
+        codebook = Codebook(title, q)
+        if cache_dir is not None:
+            QsfParser.save_cached_codebook(codebook, cache_file)
+        return(codebook)
+
+    def get_codebook_cache_file(self, cache_dir, title):
+        """
+        Returns the cache file path for this qsf, which is keyed by a
+        hash of the qsf bytes, the parser options and the title
+        """
+        key = json.dumps([CODEBOOK_CACHE_VERSION, self.qsf_hash, 
+                          self.options, title], sort_keys=True)
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return(os.path.join(cache_dir, "codebook_{}.pkl".format(digest)))
+
+    @staticmethod
+    def load_cached_codebook(cache_file):
+        if not os.path.exists(cache_file):
+            return(None)
+        try:
+            with open(cache_file, 'rb') as f:
+                return(pickle.load(f))
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+                ImportError) as e:
+            logging.warning("Ignoring unreadable codebook cache {}: {}".format(
+                            cache_file, e))
+            return(None)
+
+    @staticmethod
+    def save_cached_codebook(codebook, cache_file):
+        with atomic_write(cache_file) as tmp:
+            with open(tmp, 'wb') as f:
+                pickle.dump(codebook, f, pickle.HIGHEST_PROTOCOL)
 
     def get_survey_title(self):
         return(self.qsf['SurveyEntry']['SurveyName'])
@@ -42,9 +152,7 @@ class QsfParser:
         Return a list of block ids in the order they appear in the
         survey
         """
-        flow_info = [e['Payload']['Flow'] 
-                     for e in self.qsf['SurveyElements']
-                     if e['Element'] == 'FL']
+        flow_info = [e['Payload']['Flow'] for e in self.get_elements('FL')]
         if len(flow_info) != 1:
             raise(Exception("Invalid flow specification"))
         block_order = [e['ID'] for e in flow_info[0]
@@ -56,8 +164,7 @@ class QsfParser:
         Returns a dictionary mapping block id to the dictionary
         containing all the block info
         """
-        block_info = [e['Payload'] for e in self.qsf['SurveyElements']
-                      if e['Element'] == 'BL']
+        block_info = [e['Payload'] for e in self.get_elements('BL')]
         if len(block_info) != 1:
             raise(Exception("Invalid block specification"))
         blocks = block_info[0]
@@ -96,17 +203,13 @@ class QsfParser:
         return(ordered_qids)
 
     def get_dynamic_choice_json(self, locator):
-        other_q = self.qsf['SurveyElements']
         m = re.search('q://(.+?)/', locator)
         if m:
             qid = m.group(1)
         else:
             logging.info("No dynamic choices found")
             return({})
-        for j in self.qsf['SurveyElements']:
-            if j['Element'] == 'SQ' and j['Payload']['QuestionID'] == qid:
-                return(j)
-        return({})
+        return(self.questions_by_id.get(qid, {}))
 
 
     def get_question_json(self, qids):
@@ -115,9 +218,8 @@ class QsfParser:
         corresponding parsed JSON. Returns a dict, mapping QID to to
         parsed JSON dict
         """
-        q = [e for e in self.qsf['SurveyElements'] 
-             if e['Element'] == 'SQ' 
-             and e['Payload']['QuestionID'] in qids]
+        q = [self.questions_by_id[qid] for qid in qids
+             if qid in self.questions_by_id]
         questions = {}
         for i in q:
             # if a question pipes in dynamic choices from another question,
@@ -144,26 +246,27 @@ class QsfParser:
 
         questions = []
         for id in qids:
-            json = qid_to_json[id]['Payload']
-            if (json['QuestionType'] == 'MC' and 
-            json['Selector'] in ['SAVR', 'SAHR', 'DL', 'SACOL']):
-                questions.append(self.build_sqsr(json))
-            elif (json['QuestionType'] == 'MC' and 
-            json['Selector'] in ['MACOL', 'MAVR']):
-                questions.append(self.build_sqmr(json))
-            elif (json['QuestionType'] == 'Matrix' and
-            json['Selector'] == 'Likert' and json['SubSelector'] ==
-            'SingleAnswer'):
-                questions.append(self.build_mqsr(json))
-            elif (json['QuestionType'] == 'Matrix' and
-            json['Selector'] == 'Likert' and json['SubSelector'] ==
-            'MultipleAnswer'):
-                questions.append(self.build_mqmr(json))
-            else:
-                txt = json['QuestionText']
-                qtype = json['QuestionType']
-                select = json['Selector']
-                logging.info("Skipping question {}\n\nType: {}\nSelector: {}")
+            with profile_stage('build_question', id):
+                json = qid_to_json[id]['Payload']
+                if (json['QuestionType'] == 'MC' and 
+                json['Selector'] in ['SAVR', 'SAHR', 'DL', 'SACOL']):
+                    questions.append(self.build_sqsr(json))
+                elif (json['QuestionType'] == 'MC' and 
+                json['Selector'] in ['MACOL', 'MAVR']):
+                    questions.append(self.build_sqmr(json))
+                elif (json['QuestionType'] == 'Matrix' and
+                json['Selector'] == 'Likert' and json['SubSelector'] ==
+                'SingleAnswer'):
+                    questions.append(self.build_mqsr(json))
+                elif (json['QuestionType'] == 'Matrix' and
+                json['Selector'] == 'Likert' and json['SubSelector'] ==
+                'MultipleAnswer'):
+                    questions.append(self.build_mqmr(json))
+                else:
+                    txt = json['QuestionText']
+                    qtype = json['QuestionType']
+                    select = json['Selector']
+                    logging.info("Skipping question {}\n\nType: {}\nSelector: {}")
         return(questions)
 
     def _recode_exclusions(self, exclusions, recode):
@@ -3,7 +3,11 @@ import pandas as pd
 import numpy as np
 from abc import ABCMeta, abstractmethod
 from surveyhelper.scale import QuestionScale, LikertScale, NominalScale, OrdinalScale
-from scipy.stats import ttest_ind, f_oneway, chisquare
+from surveyhelper.tally import Tally, group_codes, indicator_block, \
+count_indicators_by_group, value_codes, crosstab_codes, count_values_by_column, \
+count_moments, effective_sizes, row_weights
+from surveyhelper.significance import compare_means, chisquare_by_choice, \
+scale_to_effective_size
 
 class MatrixQuestion:
     __metaclass__ = ABCMeta
@@ -64,6 +68,34 @@ class MatrixQuestion:
     def get_children_text(self):
         return([q.text for q in self.questions])
 
+    def cut_by_question(self, other_question, response_set, 
+                        cut_var_label=None, question_labels=None,
+                        pct_format=".0%", remove_exclusions=True, 
+                        show_mean=True, mean_format=".1f"):
+        """
+        Cuts every row question by other_question, stacking the rows'
+        tables
+        """
+        if type(other_question) != SelectOneQuestion:
+            raise(Exception("Can only call cut_by_question on a SelectOneQuestion type"))
+        labels = question_labels
+        if not labels:
+            labels = [q.text for q in self.questions]
+        results = []
+        for q, l in zip(self.questions, labels):
+            r = q.cut_by_question(other_question, response_set, 
+                                  cut_var_label, l, pct_format, 
+                                  remove_exclusions, show_mean, mean_format)
+            results.append(r.T)
+        return(pd.concat(results))
+
+    def effective_sample_size(self, df, remove_exclusions=True):
+        """
+        Returns the effective sample size of each row question
+        """
+        return([q.effective_sample_size(df, remove_exclusions) 
+                for q in self.questions])
+
     def pretty_print(self, show_choices=True):
         print("{} ({})".format(self.text, self.label))
         if show_choices:
@@ -100,21 +132,29 @@ class SelectOneMatrixQuestion(MatrixQuestion):
                         show_mean=True, mean_format=".1f"):
         if len(self.questions) == 0:
             return(pd.DataFrame())
-        data = []
-        if show == "ct":
-            for q in self.questions:
-                data.append(q.frequency_table(df, False, True,
-                            False, pct_format, remove_exclusions,
-                            show_totals, show_mean,
-                           ).iloc[:,0].tolist())
-        elif show == "pct":
-            for q in self.questions:
-                data.append(q.frequency_table(df, False, False,
-                            True, pct_format, remove_exclusions, 
-                            show_totals, show_mean
-                           ).iloc[:,0].tolist())
-        else:
+        if show not in ["ct", "pct"]:
             raise(Exception("Invalid 'show' parameter: {}".format(show)))
+        cts = self.count_matrix(df, remove_exclusions)
+        values = self.get_scale().get_values(remove_exclusions)
+        resp = cts.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = cts.dot(np.asarray(values, dtype=float)) / resp
+        data = []
+        for c, n, m in zip(cts, resp, means):
+            if show == "ct":
+                row = c.tolist()
+                total = n.item()
+            elif n > 0:
+                row = [format(x/n, pct_format) for x in c]
+                total = format(1, pct_format)
+            else:
+                row = ["-"]*len(c)
+                total = format(1, pct_format)
+            if show_totals:
+                row.append(total)
+            if show_mean:
+                row.append(format(m, mean_format))
+            data.append(row)
         tbl = pd.DataFrame(data)
         tmpcols = self.get_choices(remove_exclusions)
 
@@ -129,32 +169,38 @@ class SelectOneMatrixQuestion(MatrixQuestion):
         tbl = tbl[cols]
         return(tbl)
 
-    def cut_by_question(self, other_question, response_set, 
-                        cut_var_label=None, question_labels=None,
-                        pct_format=".0%", remove_exclusions=True, 
-                        show_mean=True, mean_format=".1f"):
-        if type(other_question) != SelectOneQuestion:
-            raise(Exception("Can only call cut_by_question on a SelectOneQuestion type"))
-        groups = response_set.groupby(other_question.label)
-        group_mapping = dict(zip(other_question.values, other_question.choices))
-        oth_text = cut_var_label
-        if not oth_text:
-            oth_text = other_question.text
-        return(self.cut_by(groups, group_mapping, oth_text, question_labels,
-               pct_format, remove_exclusions, show_mean, mean_format))
+    def count_matrix(self, df, remove_exclusions=True):
+        """
+        Returns a (rows x choices) array of answer counts for the whole
+        matrix. The data is counted in one pass over the block of row
+        variables, since every row shares the same scale, and weighted
+        when a weighted ResponseSet is given, which also caches the
+        counts. Only a ResponseSet without its data in memory (e.g.
+        streamed) is counted from each row's tally.
+        """
+        values = self.get_scale().get_values(remove_exclusions)
+        if isinstance(df, pd.DataFrame):
+            return(count_values_by_column(df, self.get_variable_names(), 
+                                          values))
+        if df.data is not None:
+            return(df.get_cached_matrix_counts(self, remove_exclusions))
+        cts = [q.tally(df, remove_exclusions)[0] for q in self.questions]
+        return(np.array(cts).reshape(len(cts), len(values)))
 
     def cut_by(self, groups, group_label_mapping, cut_var_label, 
                question_labels=None, pct_format=".0%",
-               remove_exclusions=True, show_mean=True, mean_format=".1f"):
+               remove_exclusions=True, show_mean=True, mean_format=".1f",
+               weights=None):
 
         results = []
         labels = question_labels
         if not labels:
             labels = [q.text for q in self.questions]
+        weights = row_weights(groups.obj, weights)
         for q, l in zip(self.questions, labels):
             r = q.cut_by(groups, group_label_mapping, cut_var_label,
                          l, pct_format, remove_exclusions, 
-                         show_mean, mean_format)
+                         show_mean, mean_format, weights)
             # r.columns = pd.MultiIndex.from_tuples([(q.text, b) for a, b in 
             #             r.columns.tolist()])
             results.append(r.T)
@@ -182,31 +228,26 @@ class SelectMultipleMatrixQuestion(MatrixQuestion):
 
     def get_choices(self, remove_exclusions=True):
         self.assert_choices_same()
-        if len(self.questions > 0):
-            return(self.questions[0].get_choices(remove_exclusions))
+        if len(self.questions) > 0:
+            return(self.questions[0].scale.get_choices(remove_exclusions))
         else:
-            []
+            return([])
 
     def frequency_table(self, df, show="ct", pct_format=".0%",
                         remove_exclusions = True, show_totals=True):
+        if show not in ["ct", "pct_respondents", "pct_responses"]:
+            raise(Exception("Invalid 'show' parameter: {}".format(show)))
         data = []
-        if show == "ct":
-            for q in self.questions:
-                data.append(q.frequency_table(df, False, True,
-                            False, False, pct_format, remove_exclusions,
-                            False).iloc[:,0].tolist())
-        elif show == "pct_respondents":
-            for q in self.responses:
-                data.append(q.frequency_table(df, False, False, 
-                            True, False, pct_format, remove_exclusions,
-                            False).iloc[:,0].tolist())
-        elif show == "pct_responses":
-            for q in self.responses:
-                data.append(q.frequency_table(df, False, False, 
-                            False, True, pct_format, remove_exclusions,
-                            False).iloc[:,0].tolist())
-        else:
-            raise(Exception("Invalid 'show' parameter: {}".format(show)))       
+        tots = []
+        for q in self.questions:
+            cts, resp, nonresp = q.tally(df, remove_exclusions)
+            if show == "ct":
+                data.append(cts)
+            elif show == "pct_respondents":
+                data.append([format(x/resp, pct_format) for x in cts])
+            else:
+                data.append([format(x/sum(cts), pct_format) for x in cts])
+            tots.append(resp)
         tbl = pd.DataFrame(data)
 
         tbl.columns = self.get_choices(remove_exclusions)
@@ -215,9 +256,6 @@ class SelectMultipleMatrixQuestion(MatrixQuestion):
         cols = cols[-1:] + cols[:-1]
         tbl = tbl[cols]
         if show_totals:
-            tots = []
-            for q in self.questions:
-                tots.append(q.get_total_respondents(df))
             tbl["Total Respondents"] = tots
         return(tbl)
 
@@ -253,9 +291,34 @@ class SelectQuestion:
         pass
 
     @abstractmethod
-    def tally(self):
+    def accumulate(self, df, weights=None):
         pass
 
+    @abstractmethod
+    def tally_summary(self, summary, remove_exclusions=True):
+        pass
+
+    def tally(self, df, remove_exclusions=True):
+        """
+        Returns ([response frequencies], respondents, nonrespondents) 
+        tuple where response frequencies is a count of responses for 
+        each answer choice in order. df is either a DataFrame of 
+        responses or a ResponseSet, which may supply a precomputed tally.
+        """
+        if not isinstance(df, pd.DataFrame):
+            return(df.tally(self, remove_exclusions))
+        return(self.tally_summary(self.accumulate(df), remove_exclusions))
+
+    def effective_sample_size(self, df, remove_exclusions=True):
+        """
+        Returns the Kish effective sample size of the respondents. For a
+        DataFrame, or an unweighted ResponseSet, this is the number of
+        respondents.
+        """
+        if not isinstance(df, pd.DataFrame):
+            return(df.effective_sample_size(self, remove_exclusions))
+        return(self.accumulate(df).effective_size(remove_exclusions))
+
     @abstractmethod
     def frequency_table(self):
         pass
@@ -297,22 +360,33 @@ class SelectOneQuestion(SelectQuestion):
         else:
             return(np.nan)
 
-    def tally(self, df, remove_exclusions=True):
+    def accumulate(self, df, weights=None):
         """
-        Returns ([response frequencies], respondents, nonrespondents) 
-        tuple where response frequencies is a count of responses for 
-        each answer choice in order.
+        Returns a Tally of df counting each value on the scale, 
+        including excluded ones. With weights (one per row of df), each
+        row counts its weight.
         """
-        unit_record = df[self.variable]
-        freqs = dict(unit_record.value_counts())
-        cts = []
-        values = self.scale.get_values(remove_exclusions)
-        for k in values:
-            if k in freqs:
-                cts.append(freqs[k])
-            else:
-                cts.append(0)
-        return((cts, sum(cts), len(unit_record)-sum(cts)))
+        values = self.scale.get_values(False)
+        codes = value_codes(df[self.variable], values) + 1
+        cts = np.bincount(codes, weights=weights, 
+                          minlength=len(values)+1)[1:]
+        included = np.array([not x for x in self.scale.exclude_from_analysis],
+                            dtype=bool)
+        respondents = {False: cts.sum().item(), 
+                       True: cts[included].sum().item()}
+        signature = self.scale.signature()
+        if weights is None:
+            return(Tally(values, cts, respondents, len(df), 
+                         signature=signature))
+        sq = np.bincount(codes, weights=weights**2, 
+                         minlength=len(values)+1)[1:]
+        sumsq = {False: sq.sum().item(), True: sq[included].sum().item()}
+        return(Tally(values, cts, respondents, weights.sum().item(), sumsq,
+                     signature))
+
+    def tally_summary(self, summary, remove_exclusions=True):
+        cts = summary.get_counts(self.scale.get_values(remove_exclusions))
+        return((cts, sum(cts), summary.rows-sum(cts)))
 
 
     def frequency_table(self, df, show_question=True, ct=True, 
@@ -364,41 +438,80 @@ class SelectOneQuestion(SelectQuestion):
                         show_mean=True, mean_format=".1f"):
         if type(other_question) != SelectOneQuestion:
             raise(Exception("Can only call cut_by_question on a SelectOneQuestion type"))
-        df = response_set.data.copy()
-        # Here we remove the exclusions for the cut variable, the 
-        # exclusions for this question are removed in cut_by, if 
-        # appropriate
-        if remove_exclusions:
-            values_to_drop = other_question.scale.excluded_choices()
-            for v in values_to_drop:
-                df[other_question.variable].replace(v, np.nan,
-                                                    inplace=True)
-
-        groups = df.groupby(other_question.label)
+        # The cut variable's exclusions are dropped by its (cached) 
+        # factorization, so the response data is never copied; the
+        # exclusions for this question are removed in count_by_group
+        codes, keys = response_set.factorize_cut(other_question, 
+                                                 remove_exclusions)
+        cts = response_set.count_by_group(self, codes, len(keys), 
+                                          remove_exclusions)
+        sizes = response_set.group_effective_sizes(self, codes, len(keys),
+                                                   remove_exclusions)
         group_mapping = dict(zip(other_question.scale.values, other_question.scale.choices))
 
         oth_text = cut_var_label
         if not oth_text:
             oth_text = other_question.text
-        return(self.cut_by(groups, group_mapping, oth_text, question_label,
-               pct_format, remove_exclusions, show_mean, mean_format))
+        return(self.cut_table(keys, cts, group_mapping, oth_text, 
+               question_label, pct_format, remove_exclusions, show_mean,
+               mean_format, sizes))
 
     def cut_by(self, groups, group_label_mapping, cut_var_label, 
                question_label=None, pct_format=".0%",
-               remove_exclusions=True, show_mean=True, mean_format=".1f"):
-
-        freqs = []
-        for k, gp in groups:
-            t = (self.frequency_table(gp, True, False, True, pct_format,
-                 remove_exclusions, False, show_mean, mean_format))
-            t.set_index("Answer", inplace=True)
-            series = t.ix[:,0]
-            series.name = group_label_mapping[k]
-            freqs.append(series)
-        df = pd.DataFrame(freqs)
+               remove_exclusions=True, show_mean=True, mean_format=".1f",
+               weights=None):
+        """
+        Cuts the question by a pandas groupby object. weights optionally
+        gives a weight per row of groups.obj (or names its weight 
+        column), making the percentages and means weighted.
+        """
+        codes, keys = group_codes(groups)
+        weights = row_weights(groups.obj, weights)
+        cts = self.count_by_group(groups.obj, codes, len(keys), 
+                                  remove_exclusions, weights)
+        sizes = None
+        if weights is not None:
+            sq = self.count_by_group(groups.obj, codes, len(keys),
+                                     remove_exclusions, weights**2)
+            sizes = effective_sizes(cts.sum(axis=1), sq.sum(axis=1))
+        return(self.cut_table(keys, cts, group_label_mapping, cut_var_label,
+               question_label, pct_format, remove_exclusions, show_mean,
+               mean_format, sizes))
+
+    def cut_table(self, keys, cts, group_label_mapping, cut_var_label, 
+                  question_label=None, pct_format=".0%",
+                  remove_exclusions=True, show_mean=True, mean_format=".1f",
+                  effective_n=None):
+        """
+        Formats a (groups x choices) array of counts, one row per group
+        key, into the table returned by cut_by. For weighted counts,
+        effective_n gives each group's effective sample size, to 
+        which the counts are scaled for the significance test.
+        """
+        resp = cts.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = cts.dot(np.asarray(self.scale.get_values(remove_exclusions),
+                                       dtype=float)) / resp
+        rows = []
+        for c, n, m in zip(cts, resp, means):
+            if n > 0:
+                row = [format(x/n, pct_format) for x in c]
+            else:
+                row = ["-"]*len(c)
+            if show_mean:
+                row.append(format(m, mean_format))
+            rows.append(row)
+        cols = self.scale.choices_to_str(remove_exclusions, True)
+        if show_mean:
+            cols = cols + ["Mean"]
+        df = pd.DataFrame(rows, columns=cols,
+                          index=[group_label_mapping[k] for k in keys])
 
         if show_mean:
-            if self.compare_groups(groups):
+            test_cts = cts
+            if effective_n is not None:
+                test_cts = scale_to_effective_size(cts, resp, effective_n)
+            if self.means_differ(test_cts, .05, remove_exclusions):
                 df.columns = df.columns.tolist()[:-1] + \
                              [df.columns.tolist()[-1]+"*"]
 
@@ -407,7 +520,7 @@ class SelectOneQuestion(SelectQuestion):
             my_label = self.text
 
         # Add hierarchical index to rows
-        top_index = [cut_var_label]*len(groups)
+        top_index = [cut_var_label]*len(keys)
         df.index = pd.MultiIndex.from_arrays([top_index, 
                    df.index.tolist()])
 
@@ -420,17 +533,30 @@ class SelectOneQuestion(SelectQuestion):
 
         return(df)
 
-    def compare_groups(self, groupby, pval = .05):
-        data = [d[self.variable].dropna() for groupname, d in groupby]
-        if len(groupby) == 2:
-            ts, ps = ttest_ind(*data, equal_var=False)
-            return(ps < pval)
-        elif len(groupby.groups.keys()) == 2:
-            # ANOVA
-            f, p = f_oneway(*data)
-            return(p < .05)
-        else:
-            return(False)
+    def count_by_group(self, df, codes, n_groups, remove_exclusions=True,
+                       weights=None):
+        """
+        Returns an (n_groups x choices) array of answer counts (or 
+        weights), given each row's group code (-1 for rows in no group)
+        """
+        values = self.scale.get_values(remove_exclusions)
+        return(crosstab_codes(codes, value_codes(df[self.variable], values),
+                              n_groups, len(values), weights))
+
+    def compare_groups(self, groupby, pval = .05, remove_exclusions=True):
+        codes, keys = group_codes(groupby)
+        cts = self.count_by_group(groupby.obj, codes, len(keys), 
+                                  remove_exclusions)
+        return(self.means_differ(cts, pval, remove_exclusions))
+
+    def means_differ(self, cts, pval = .05, remove_exclusions=True):
+        """
+        Tests whether the mean answer differs across groups, given a 
+        (groups x choices) array of counts: Welch's t-test for two
+        groups, one-way ANOVA for more
+        """
+        n, s, ss = count_moments(cts, self.scale.get_values(remove_exclusions))
+        return(bool(compare_means(n, s, ss) < pval))
 
     def freq_table_to_json(self, df):
         t = self.frequency_table(df, True, True, True, ".9f", True, False, 
@@ -474,32 +600,64 @@ class SelectMultipleQuestion(SelectQuestion):
                 l.append("{} ({})".format(c, v))
         print(", ".join(l))
 
-    def tally(self, df, remove_exclusions=True):
+    def accumulate(self, df, weights=None):
+        """
+        Returns a Tally of df counting the responses to every choice
+        variable, including excluded ones. With weights (one per row of
+        df), each row counts its weight.
+        """
+        return(self.accumulate_block(indicator_block(df, self.variables),
+                                     weights))
+
+    def accumulate_block(self, block, weights=None):
+        """
+        Returns the Tally of a boolean (rows x variables) indicator block
+        """
+        included = np.array([not x for x in self.scale.exclude_from_analysis],
+                            dtype=bool)
+        answered = {False: block.any(axis=1), 
+                    True: block[:, included].any(axis=1)}
+        signature = self.scale.signature()
+        if weights is None:
+            respondents = dict((k, int(v.sum())) for k, v in answered.items())
+            return(Tally(self.variables, block.sum(axis=0), respondents, 
+                         len(block), signature=signature))
+        respondents = dict((k, weights[v].sum().item()) 
+                           for k, v in answered.items())
+        sumsq = dict((k, (weights[v]**2).sum().item()) 
+                     for k, v in answered.items())
+        return(Tally(self.variables, weights.dot(block), respondents, 
+                     weights.sum().item(), sumsq, signature))
+
+    def accumulate_packed(self, packed, weights=None):
+        """
+        Returns the same Tally as accumulate, from PackedIndicators
+        """
+        if weights is not None:
+            return(self.accumulate_block(packed.unpack(self.variables), 
+                                         weights))
+        respondents = {False: packed.respondents(self.variables),
+                       True: packed.respondents(self.get_tally_variables(True))}
+        return(Tally(self.variables, packed.counts(self.variables), 
+                     respondents, packed.rows, 
+                     signature=self.scale.signature()))
+
+    def tally_summary(self, summary, remove_exclusions=True):
         """
         Returns (list, int1, int2) tuple where list is a count of
         responses for each answer choice. Int1 is the number of 
         respondents, and int2 is the number of nonrespondents.
         """
+        cts = summary.get_counts(self.get_tally_variables(remove_exclusions))
+        resp = summary.respondents[remove_exclusions]
+        return(cts, resp, summary.rows - resp)
+
+    def get_tally_variables(self, remove_exclusions=True):
         vars = self.variables
         if remove_exclusions:
             vars = list(compress(vars, 
                    [not x for x in self.scale.exclude_from_analysis]))
-        unit_record = df[vars]
-        nonrespondents = 0
-        respondents = 0
-
-        cts = [0]*len(vars)
-        for index, row in unit_record.iterrows():
-            if row.dropna().empty:
-                nonrespondents += 1
-            else:
-                respondents += 1
-                ct = 0
-                for i, v in row.iteritems():
-                    if not np.isnan(v):
-                        cts[ct] += 1
-                    ct += 1
-        return(cts, respondents, nonrespondents)
+        return(vars)
 
 
     def frequency_table(self, df, show_question=True, ct=True, 
@@ -539,83 +697,124 @@ class SelectMultipleQuestion(SelectQuestion):
                         show_mean=True, mean_format=".1f"):
         if type(other_question) != SelectOneQuestion:
             raise(Exception("Can only call cut_by_question on a SelectOneQuestion type"))
-        df = response_set.copy()
-        # Here we remove the exclusions for the cut variable, the 
-        # exclusions for this question are removed in cut_by, if 
-        # appropriate
-        if remove_exclusions:
-            values_to_drop = [v for v, e in zip(other_question.values, 
-                              other_question.scale.exclude_from_analysis) if e]
-            for v in values_to_drop:
-                df[other_question.variable].replace(v, np.nan,
-                                                      inplace=True)
-
-        groups = df.groupby(other_question.label)
+        # The cut variable's exclusions are dropped by its (cached) 
+        # factorization, so the response data is never copied; the
+        # exclusions for this question are removed in count_by_group
+        codes, keys = response_set.factorize_cut(other_question, 
+                                                 remove_exclusions)
+        cts, resp = response_set.count_by_group(self, codes, len(keys),
+                                                remove_exclusions)
+        sizes = response_set.group_effective_sizes(self, codes, len(keys),
+                                                   remove_exclusions)
         group_mapping = dict(zip(other_question.scale.values, other_question.scale.choices))
 
         oth_text = cut_var_label
         if not oth_text:
             oth_text = other_question.text
-        return(self.cut_by(groups, group_mapping, oth_text, question_label,
-               pct_format, remove_exclusions))
+        return(self.cut_table(keys, cts, resp, group_mapping, oth_text, 
+               question_label, pct_format, remove_exclusions, sizes))
 
 
     def cut_by(self, groups, group_label_mapping, cut_var_label, 
                question_label=None, pct_format=".0%",
-               remove_exclusions=True):
-
-        freqs = []
-        for k, gp in groups:
-            t = (self.frequency_table(gp, True, False, True, False, 
-                 pct_format, remove_exclusions, False))
-            t.set_index("Answer", inplace=True)
-            series = t.ix[:,0]
-            series.name = group_label_mapping[k]
-            freqs.append(series)
-        df = pd.DataFrame(freqs)
+               remove_exclusions=True, weights=None):
+        """
+        Cuts the question by a pandas groupby object. weights optionally
+        gives a weight per row of groups.obj (or names its weight 
+        column), making the percentages weighted.
+        """
+        codes, keys = group_codes(groups)
+        weights = row_weights(groups.obj, weights)
+        cts, resp = self.count_by_group(groups.obj, codes, len(keys),
+                                        remove_exclusions, weights)
+        sizes = None
+        if weights is not None:
+            sq = self.count_by_group(groups.obj, codes, len(keys),
+                                     remove_exclusions, weights**2)[1]
+            sizes = effective_sizes(resp, sq)
+        return(self.cut_table(keys, cts, resp, group_label_mapping, 
+               cut_var_label, question_label, pct_format, remove_exclusions,
+               sizes))
+
+    def cut_table(self, keys, cts, resp, group_label_mapping, cut_var_label,
+                  question_label=None, pct_format=".0%", 
+                  remove_exclusions=True, effective_n=None):
+        """
+        Formats a (groups x choices) array of counts and the number of
+        respondents in each group, one row per group key, into the 
+        table returned by cut_by. For weighted counts, effective_n
+        gives each group's effective sample size, to which the counts 
+        are scaled for the significance test.
+        """
+        rows = []
+        for c, n in zip(cts, resp):
+            rows.append([format(x/n, pct_format) if n > 0 else "-" 
+                         for x in c])
+        choices = self.scale.get_choices(remove_exclusions)
+        df = pd.DataFrame(rows, columns=choices,
+                          index=[group_label_mapping[k] for k in keys])
 
         my_label = question_label
         if not my_label:
             my_label = self.text
 
         # Add significance flags
-        sigs = self.compare_groups(groups, remove_exclusions)
+        if effective_n is not None:
+            sigs = chisquare_by_choice(
+                   scale_to_effective_size(cts, resp, effective_n),
+                   effective_n) < .05
+        else:
+            sigs = chisquare_by_choice(cts, resp) < .05
         newcols = []
-        for s, i in zip(sigs, df.columns.tolist()):
+        for s, i in zip(sigs, choices):
             if s:
                 newcols.append(i + "*")
             else:
                 newcols.append(i)
 
         # Add hierarchical index to rows
-        top_index = [cut_var_label]*len(groups)
+        top_index = [cut_var_label]*len(keys)
         df.index = pd.MultiIndex.from_arrays([top_index, 
                    df.index.tolist()])
 
         # Add hierarchical index to columns
-        col_top_index = [my_label]*len(self.choices)
+        col_top_index = [my_label]*len(choices)
         df.columns = pd.MultiIndex.from_arrays([col_top_index, 
                      newcols])
 
         return(df)
 
+    def count_by_group(self, df, codes, n_groups, remove_exclusions=True,
+                       weights=None):
+        """
+        Returns (counts, respondents) given each row's group code (-1 
+        for rows in no group), where counts is an (n_groups x choices)
+        array and respondents has one entry per group. With weights, 
+        both are sums of weights.
+        """
+        block = indicator_block(df, self.get_tally_variables(remove_exclusions))
+        return(count_indicators_by_group(block, codes, n_groups, weights))
+
+    def cooccurrence(self, df, remove_exclusions=True):
+        """
+        Returns a DataFrame counting, for each pair of choices, the 
+        respondents who selected both. df is a DataFrame or a 
+        ResponseSet.
+        """
+        vars = self.get_tally_variables(remove_exclusions)
+        if isinstance(df, pd.DataFrame):
+            block = indicator_block(df, vars).astype(np.int64)
+            cts = block.T.dot(block)
+        else:
+            cts = df.cooccurrence(self, remove_exclusions)
+        choices = self.scale.get_choices(remove_exclusions)
+        return(pd.DataFrame(cts, index=choices, columns=choices))
+
     def compare_groups(self, groupby, remove_exclusions=True, pval = .05):
-        groupnames = groupby.groups.keys()
-        obs_by_cut = []
-        ct_by_cut = []
-        for k, df in groupby:
-            freqs, tot_resp, tot_nonresp = self.tally(df, remove_exclusions)
-            obs_by_cut.append(freqs)
-            ct_by_cut.append(tot_resp)
-        choice_totals = [sum(x) for x in zip(*obs_by_cut)]
-        exp_prop_per_choice = [t/sum(ct_by_cut) for t in choice_totals]
-        sigs = []
-        for f_obs, choice_tot, p_choice in zip(zip(*obs_by_cut), 
-            choice_totals, exp_prop_per_choice):
-            f_exp = [p_choice * ct for ct in ct_by_cut]
-            chisq, p = chisquare(f_obs, f_exp)
-            sigs.append(p < pval)
-        return(sigs)
+        codes, keys = group_codes(groupby)
+        counts, ct_by_cut = self.count_by_group(groupby.obj, codes, len(keys),
+                                                remove_exclusions)
+        return((chisquare_by_choice(counts, ct_by_cut) < pval).tolist())
 
     def freq_table_to_json(self, df):
         t = self.frequency_table(df, True, True, True, False, ".9f", True, False)
@@ -0,0 +1,189 @@
+"""
+Raking
+------
+Iterative proportional fitting (RIM weighting) of respondent weights to
+target marginals. Rows are first collapsed into cells, one per distinct
+combination of group codes and base weight, so every iteration works on
+the cell totals rather than on the rows; the cost per iteration depends
+on the number of occupied cells, not on the number of respondents.
+"""
+
+import numpy as np
+import pandas as pd
+
+def rake_codes(codes, targets, base_weights=None, tol=1e-6, max_iter=100,
+               trim=None):
+    """
+    Rakes weights so that, for each dimension, the weighted shares of
+    its categories match the targets.
+
+    codes is a list of integer arrays, one per dimension, giving each
+    row's category (-1 for a missing answer, which leaves the row out
+    of that dimension's adjustment). targets is a list of the same
+    length, each giving the target share (or any total, which is
+    normalized) of every category of that dimension. base_weights
+    optionally gives starting weights, e.g. design weights.
+
+    Iteration stops once every weighted share is within tol of its
+    target, or after max_iter passes over the dimensions. trim bounds
+    the weights to multiples of the mean weight: either (lower, upper)
+    or just upper. After each pass the weights are trimmed (see 
+    trim_factors), raking continues from the trimmed weights, and the
+    weights returned are the trimmed ones, so they always lie within
+    the bounds when the bounds can be met at all.
+
+    Returns (weights, iterations, converged). The weights sum to the
+    total of the base weights.
+    """
+    codes = [np.asarray(c, dtype=np.int64) for c in codes]
+    targets = [np.asarray(t, dtype=float) / np.sum(t) for t in targets]
+    if len(codes) == 0 or len(codes) != len(targets):
+        raise(Exception("Expected one target per dimension"))
+    rows = len(codes[0])
+    if base_weights is None:
+        base_weights = np.ones(rows)
+    base_weights = np.asarray(base_weights, dtype=float)
+    for c, t in zip(codes, targets):
+        if len(c) != rows:
+            raise(Exception("Every dimension needs a code for each row"))
+        if c.max(initial=-1) >= len(t):
+            raise(Exception("Found a category without a target"))
+    if trim is not None and np.isscalar(trim):
+        trim = (0, trim)
+
+    cell, cell_codes, cell_base = collapse_cells(codes, base_weights)
+    cell_rows = np.bincount(cell, minlength=len(cell_base))
+    cell_mass = cell_rows * cell_base
+    total = cell_mass.sum()
+    # a missing answer becomes one extra category, whose adjustment is
+    # always 1, so no masking is needed inside the loop
+    cell_codes = [np.where(c >= 0, c, len(t)) 
+                  for c, t in zip(cell_codes, targets)]
+
+    factor = np.ones(len(cell_base))
+    converged = False
+    feasible = True
+    iterations = 0
+    while iterations < max_iter and not converged:
+        iterations += 1
+        for c, t in zip(cell_codes, targets):
+            current = np.bincount(c, weights=cell_mass * factor,
+                                  minlength=len(t)+1)[:-1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                adjust = np.where(current > 0, t * current.sum() / current, 1)
+            factor *= np.append(adjust, 1)[c]
+        if trim is not None:
+            factor, feasible = trim_factors(factor, cell_base, cell_rows, 
+                                            trim)
+        converged = max_share_error(cell_codes, targets, 
+                                    cell_mass * factor) < tol
+
+    weights = cell_base * factor
+    if trim is None:
+        # trim_factors keeps the total exactly; without it, rounding may
+        # have moved it slightly
+        weights *= total / (cell_rows * weights).sum() if total > 0 else 1
+    elif not feasible:
+        print("Warning: Weights cannot all be trimmed to between {} and {} "
+              "times the mean weight".format(trim[0], trim[1]))
+    return(weights[cell], iterations, converged)
+
+def collapse_cells(codes, base_weights):
+    """
+    Groups rows sharing every code and their base weight. Returns
+    (cell of each row, [code of each cell for each dimension], base
+    weight of each cell).
+    """
+    weight_code, weight_values = pd.factorize(base_weights)
+    columns = [c + 1 for c in codes] + [weight_code]
+    sizes = [int(c.max(initial=0)) + 1 for c in columns]
+    if np.prod(sizes, dtype=float) < 2**62:
+        key = np.ravel_multi_index(columns, sizes)
+        cell, uniques = pd.factorize(key)
+        unique_columns = np.unravel_index(uniques, sizes)
+    else:
+        unique_rows, cell = np.unique(np.column_stack(columns), axis=0,
+                                      return_inverse=True)
+        unique_columns = unique_rows.T
+        cell = cell.ravel()
+    cell_codes = [c - 1 for c in unique_columns[:-1]]
+    cell_base = np.asarray(weight_values, dtype=float)[unique_columns[-1]]
+    return(cell, cell_codes, cell_base)
+
+def trim_factors(factor, cell_base, cell_rows, trim):
+    """
+    Clips each cell's weight to trim multiples of the mean weight and
+    spreads the mass removed (or added) over the cells not clipped, 
+    until no weight is out of bounds, so the total is kept. Returns 
+    (new cell factors, whether the bounds could be met), which they
+    can be whenever trim[0] <= 1 <= trim[1].
+
+    Rather than repeating clip-and-rescale, the scale s applied to the
+    unclipped cells is solved for directly: the total of the weights
+    s * w clipped to the bounds only grows with s, and is linear 
+    between the values of s at which a cell reaches a bound.
+    """
+    present = (cell_rows > 0) & (cell_base > 0)
+    weights = cell_base * factor
+    n = cell_rows[present]
+    w = weights[present]
+    total = (n * w).sum()
+    if total <= 0:
+        return(factor, True)
+    rows = n.sum()
+    mean = total / rows
+    low, high = trim[0] * mean, trim[1] * mean
+    if not (trim[0] <= 1 <= trim[1]):
+        trimmed = np.clip(w, low, high)
+        feasible = False
+    else:
+        order = np.argsort(w)
+        w_sorted = w[order]
+        cum_rows = np.concatenate([[0], np.cumsum(n[order])])
+        cum_mass = np.concatenate([[0], np.cumsum((n * w)[order])])
+
+        def regions(s):
+            # cells [0, lo) are clipped up to low, cells [hi, end) down
+            # to high
+            with np.errstate(divide='ignore', invalid='ignore'):
+                lo = np.searchsorted(w_sorted, low / s, 'right')
+                hi = np.searchsorted(w_sorted, high / s, 'left')
+            return(lo, hi)
+
+        def clipped_total(s):
+            lo, hi = regions(s)
+            return(low * cum_rows[lo] + s * (cum_mass[hi] - cum_mass[lo]) +
+                   high * (rows - cum_rows[hi]))
+
+        breaks = np.concatenate([high / w, low / w if low > 0 else []])
+        breaks = np.unique(breaks[np.isfinite(breaks) & (breaks > 0)])
+        below = np.searchsorted(clipped_total(breaks), total, 'right')
+        if below == len(breaks):
+            s = breaks[-1]
+        else:
+            left = breaks[below-1] if below > 0 else 0
+            lo, hi = regions((left + breaks[below]) / 2)
+            free_mass = cum_mass[hi] - cum_mass[lo]
+            if free_mass > 0:
+                s = (total - low * cum_rows[lo] - 
+                     high * (rows - cum_rows[hi])) / free_mass
+            else:
+                s = breaks[below]
+        trimmed = np.clip(s * w, low, high)
+        feasible = True
+    weights[present] = trimmed
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return(np.where(present, weights / cell_base, factor), feasible)
+
+def max_share_error(cell_codes, targets, mass):
+    """
+    Returns the largest absolute difference between a weighted
+    category share and its target, over every dimension. Codes equal 
+    to the number of targets mark missing answers.
+    """
+    error = 0
+    for c, t in zip(cell_codes, targets):
+        current = np.bincount(c, weights=mass, minlength=len(t)+1)[:-1]
+        if current.sum() > 0:
+            error = max(error, np.abs(current / current.sum() - t).max())
+    return(error)
@@ -1,29 +1,913 @@
+import os
+import json
+import pickle
+import hashlib
+import weakref
 import pandas as pd
 import numpy as np
+from surveyhelper.question import SelectOneQuestion, SelectMultipleQuestion
+from surveyhelper.tally import PackedIndicators, indicator_block, \
+count_indicators_by_group, value_codes, crosstab_codes, effective_sizes, \
+row_weights, count_moments, count_values_by_column
+from surveyhelper.raking import rake_codes
+from surveyhelper.significance import compare_means, chisquare_by_choice, \
+scale_to_effective_size
+from surveyhelper.profiling import profile_stage
+from surveyhelper.files import atomic_write
+
+# Rows parsed per pass when loading a response file; each chunk is
+# converted to compact dtypes before the next one is read
+READ_CHUNK_ROWS = 200000
+
+# Bump whenever the way columns are selected or converted changes, so
+# stale data caches are not reused
+DATA_CACHE_VERSION = 2
+
+# Bump whenever Tally or the state saved by incremental loading changes,
+# so old state files are rebuilt rather than reused
+STATE_VERSION = 2
+
+# Bytes at the start of the response file, and just before the last 
+# offset read, hashed to check that an incrementally loaded file has 
+# only been appended to since its state was saved
+STATE_CHECK_BYTES = 1 << 16
+
+def compact_int_dtype(lo, hi):
+    """
+    Returns the smallest nullable integer dtype that can hold every
+    value between lo and hi
+    """
+    for dtype in ['Int8', 'Int16', 'Int32']:
+        info = np.iinfo(dtype.lower())
+        if info.min <= lo and hi <= info.max:
+            return(dtype)
+    return('Int64')
+
+def select_questions(questions):
+    """
+    Returns questions with each matrix question replaced by its rows
+    """
+    rows = []
+    for q in questions:
+        if hasattr(q, 'questions'):
+            rows += q.questions
+        else:
+            rows.append(q)
+    return(rows)
+
+def build_banner(response_set, questions, cuts, remove_exclusions=True,
+                 show_mean=True):
+    """
+    Returns a filled BannerTable for each of cuts, cutting every one of
+    questions. response_set provides factorize_cut and group_counter,
+    so ResponseSet and PartitionedResponseSet share the banner.
+    """
+    factors = [response_set.factorize_cut(c, remove_exclusions) for c in cuts]
+    tables = [BannerTable(c, keys, remove_exclusions, show_mean)
+              for c, (codes, keys) in zip(cuts, factors)]
+    for child in select_questions(questions):
+        if not isinstance(child, (SelectOneQuestion, SelectMultipleQuestion)):
+            raise(Exception("Cannot cut question type {}".format(
+                            type(child).__name__)))
+        count = response_set.group_counter(child, remove_exclusions)
+        for (codes, keys), table in zip(factors, tables):
+            cts, sizes = count(codes, len(keys))
+            if isinstance(child, SelectOneQuestion):
+                table.add_select_one(child, cts, sizes)
+            else:
+                table.add_select_multiple(child, cts[0], cts[1], sizes)
+    return(tables)
+
+class BannerTable:
+    """
+    Collects one cut's banner table, a question at a time, as arrays of
+    group shares and means; to_frame formats them all at once into a 
+    single frame, with a row per question and choice and a column per
+    group of the cut. The significance tests are batched too: one test
+    of means for all the select one questions and one chi-square test
+    for all the select multiple choices.
+    """
+
+    def __init__(self, cut_question, keys, remove_exclusions=True,
+                 show_mean=True):
+        mapping = dict(zip(cut_question.scale.values, 
+                           cut_question.scale.choices))
+        self.columns = pd.MultiIndex.from_arrays([
+                       [cut_question.text]*len(keys), 
+                       [mapping[k] for k in keys]])
+        self.remove_exclusions = remove_exclusions
+        self.show_mean = show_mean
+        self.question_labels = []
+        self.row_labels = []
+        self.rows = []
+        # positions of the rows holding means rather than shares
+        self.mean_rows = []
+        # (n, sum, sum of squares) per group of each mean row's answers
+        self.moments = []
+        # positions of the select multiple rows, their counts per group
+        # and their question's respondents per group
+        self.choice_rows = []
+        self.choice_counts = []
+        self.choice_respondents = []
+
+    def add_rows(self, question, labels, rows):
+        self.question_labels += [question.text]*len(labels)
+        self.row_labels += labels
+        self.rows.append(rows)
+
+    @staticmethod
+    def shares(cts, resp):
+        """
+        Returns the (choices x groups) shares of each group's 
+        respondents, nan for groups without any
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return(np.where(resp > 0, cts.T / resp, np.nan))
+
+    def add_select_one(self, question, cts, effective_n=None):
+        """
+        Adds a select one question's rows given its (groups x choices)
+        counts, and for weighted counts each group's effective n
+        """
+        rem = self.remove_exclusions
+        resp = cts.sum(axis=1)
+        labels = question.scale.choices_to_str(rem, True)
+        rows = [BannerTable.shares(cts, resp)]
+        if self.show_mean:
+            values = np.asarray(question.scale.get_values(rem), dtype=float)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rows.append((cts.dot(values) / resp)[None, :])
+            test_cts = cts
+            if effective_n is not None:
+                test_cts = scale_to_effective_size(cts, resp, effective_n)
+            self.moments.append(count_moments(test_cts, values))
+            self.mean_rows.append(len(self.row_labels) + len(labels))
+            labels = labels + ["Mean"]
+        self.add_rows(question, labels, np.vstack(rows))
+
+    def add_select_multiple(self, question, cts, resp, effective_n=None):
+        """
+        Adds a select multiple question's rows given its (groups x
+        choices) counts and each group's respondents, and for weighted
+        counts each group's effective n
+        """
+        labels = question.scale.get_choices(self.remove_exclusions)
+        start = len(self.row_labels)
+        self.choice_rows += range(start, start + len(labels))
+        if effective_n is not None:
+            self.choice_counts.append(
+                scale_to_effective_size(cts, resp, effective_n).T)
+            resp_tested = effective_n
+        else:
+            self.choice_counts.append(np.asarray(cts, dtype=float).T)
+            resp_tested = resp
+        self.choice_respondents.append(np.broadcast_to(resp_tested, 
+                                       (len(labels), len(resp))))
+        self.add_rows(question, labels, BannerTable.shares(cts, resp))
+
+    def significant_rows(self, pval=.05):
+        """
+        Returns the positions of the rows whose test is significant: 
+        mean rows whose means differ across groups, and select multiple
+        choices whose share differs
+        """
+        rows = []
+        if self.moments:
+            n, s, ss = [np.vstack(x) for x in zip(*self.moments)]
+            p = compare_means(n, s, ss)
+            rows += [r for r, x in zip(self.mean_rows, p) if x < pval]
+        if self.choice_rows:
+            # each choice is tested as its own batch entry, with one 
+            # choice per entry, since its respondents depend on the 
+            # question
+            p = chisquare_by_choice(np.vstack(self.choice_counts)[..., None],
+                                    np.vstack(self.choice_respondents))
+            rows += [r for r, x in zip(self.choice_rows, p[:, 0]) 
+                     if x < pval]
+        return(rows)
+
+    def to_frame(self, pct_format=".0%", mean_format=".1f"):
+        rows = np.vstack(self.rows) if self.rows else \
+               np.zeros((0, len(self.columns)))
+        is_mean = np.zeros(len(rows), dtype=bool)
+        is_mean[self.mean_rows] = True
+        data = []
+        for row, mean in zip(rows.tolist(), is_mean):
+            if mean:
+                data.append([format(x, mean_format) for x in row])
+            else:
+                data.append(["-" if x != x else format(x, pct_format) 
+                             for x in row])
+        labels = list(self.row_labels)
+        for r in self.significant_rows():
+            labels[r] += "*"
+        index = pd.MultiIndex.from_arrays([self.question_labels, labels])
+        return(pd.DataFrame(data, index=index, columns=self.columns))
 
 class ResponseSet:
 
-    
-    def __init__(self, response_file, codebook, skiprows = [1], encoding="utf8"):
-        df = pd.read_csv(response_file , skiprows=skiprows, encoding=encoding)
-        # go through each variable in the codebook and make sure the corresponding 
-        # column is integer coded
+
+    def __init__(self, response_file, codebook, skiprows = [1], encoding="utf8",
+                 cut_variables = None, streaming = False, cache_dir = None,
+                 categorical = True, pack_indicators = False,
+                 weight_variable = None, state_file = None):
+        """
+        Loads the columns of response_file used by the codebook, plus any
+        cut_variables, storing coded answers as compact nullable integers.
+        With categorical=True, select one answers are further stored as 
+        pandas Categoricals whose categories are the scale's values (plus
+        any other codes found in the data), so each row costs one byte 
+        and tallies are a bincount over the category codes.
+
+        With streaming=True the file is read in chunks and only a running
+        Tally per question is kept, so self.data is None and the
+        ResponseSet should be passed in place of a DataFrame to tally, 
+        mean, frequency_table and freq_table_to_json. Exclusions must be
+        set before loading: the streamed tallies raise an exception 
+        once a question's choices or exclusions change.
+
+        If cache_dir is given (and not streaming), the converted columns
+        are saved there as an uncompressed Feather file, which later 
+        loads convert straight back to columns instead of re-parsing the
+        CSV. The data is still read into memory whole. The cache is
+        keyed by the response file's path, size and modification time
+        and by the columns and dtypes requested, so it is rebuilt when
+        any of these change. Requires pyarrow.
+
+        With pack_indicators=True, select multiple columns are moved out
+        of self.data into bit-packed PackedIndicators (one bit per row
+        and choice). Those questions must then be analysed through the
+        ResponseSet (tally, frequency_table, cut_by_question, banner,
+        cooccurrence) rather than through self.data.
+
+        If weight_variable names a column of weights, every tally, 
+        frequency table, mean, cut and banner drawn from the ResponseSet
+        is weighted, in the same pass as the counting: counts become 
+        sums of weights, and effective_sample_size gives the Kish 
+        effective sample size. Rows with a missing weight count 0.
+
+        With state_file (which implies streaming), loading is 
+        incremental: the streamed tallies are saved to state_file along
+        with the byte offset reached in response_file, and the next 
+        load with the same state_file reads only the responses appended
+        to the file since, so it takes time proportional to the new 
+        rows. Responses must be appended as whole rows. If the file's 
+        start or the bytes before the saved offset have changed, or the
+        codebook's variables, scales or the weight variable have, the
+        state is discarded and the whole file is read again.
+        """
+        header = pd.read_csv(response_file, skiprows=skiprows,
+                             encoding=encoding, nrows=0)
+        needed = set(codebook.get_variable_names())
+        if cut_variables:
+            needed.update(cut_variables)
+        if weight_variable is not None:
+            if weight_variable not in header:
+                raise(Exception("Weight variable {} not found in data file {}".format(weight_variable, response_file)))
+            needed.add(weight_variable)
+        usecols = [v for v in header.columns if v in needed]
+        dtypes = ResponseSet.get_column_dtypes(codebook)
+
         matched_questions = []
         for q in codebook.get_questions():
             matched = True
             for v in q.get_variable_names():
-                if v not in df:
+                if v not in header:
                     print("Warning: Expected variable {} not found in data file {}".format(v, response_file))
                     matched = False
-                elif df[v].dtype not in [np.int64, np.float64]:
-                    print("Converting variable {} to integer from {}".format(v, df[v].dtype))
-                    df[v] = df[v].convert_objects(convert_numeric=True)
             if matched: matched_questions.append(q)
-        self.data = df
         self.matched_questions = matched_questions
         self.codebook = codebook
+        self._data = None
+        self.tallies = {}
+        self.tally_cache = {}
+        self.cut_cache = {}
+        self.packed = {}
+        self.row_count = 0
+        self.weight_variable = weight_variable
+        self.weights = None
+        if state_file is not None:
+            streaming = True
+        with profile_stage('load_responses') as stage:
+            self.load(response_file, header, usecols, dtypes, skiprows, 
+                      encoding, streaming, cache_dir, categorical, 
+                      pack_indicators, state_file)
+            stage.rows = self.row_count
+
+    def load(self, response_file, header, usecols, dtypes, skiprows, encoding,
+             streaming, cache_dir, categorical, pack_indicators, 
+             state_file=None):
+        """
+        Reads the responses (or their cached copy) for __init__
+        """
+        offset = 0
+        if streaming:
+            self.accumulate(header[usecols])
+            if state_file is not None:
+                state_key = self.get_state_key(usecols, dtypes, skiprows,
+                                               encoding)
+                offset = self.load_state(state_file, state_key, 
+                                         response_file)
+        elif cache_dir is not None:
+            cache_file = ResponseSet.get_data_cache_file(cache_dir, 
+                         response_file, usecols, dtypes, skiprows, encoding,
+                         categorical)
+            if os.path.exists(cache_file):
+                with profile_stage('load_cached_data'):
+                    self.data = ResponseSet.load_cached_data(cache_file)
+                if pack_indicators:
+                    with profile_stage('pack_indicators', rows=self.row_count):
+                        self.pack_indicators()
+                return
+
+        chunks = []
+        converted = set()
+        loaded_rows = self.row_count
+        with profile_stage('read_csv') as stage, \
+             open(response_file, 'rb') as f:
+            f.seek(offset)
+            if offset == 0:
+                reader = pd.read_csv(f, skiprows=skiprows, encoding=encoding,
+                                     usecols=usecols, 
+                                     chunksize=READ_CHUNK_ROWS)
+            elif offset < os.fstat(f.fileno()).st_size:
+                # Resume after the last row read; the header rows are 
+                # behind us
+                reader = pd.read_csv(f, header=None, 
+                                     names=list(header.columns),
+                                     encoding=encoding, usecols=usecols,
+                                     chunksize=READ_CHUNK_ROWS)
+            else:
+                reader = []
+            for chunk in reader:
+                chunk = ResponseSet.convert_columns(chunk, dtypes, converted)
+                self.row_count += len(chunk)
+                if streaming:
+                    self.accumulate(chunk)
+                else:
+                    chunks.append(chunk)
+            end = f.tell()
+            stage.rows = self.row_count - loaded_rows
+            if state_file is not None:
+                self.save_state(state_file, state_key, f, end)
+        if not streaming:
+            if chunks:
+                self.data = pd.concat(chunks, ignore_index=True)
+            else:
+                self.data = header[usecols]
+            if categorical:
+                with profile_stage('encode_answers', rows=self.row_count):
+                    self.encode_answers()
+            if cache_dir is not None:
+                with profile_stage('save_cached_data', rows=self.row_count):
+                    ResponseSet.save_cached_data(self.data, cache_file)
+            if pack_indicators:
+                with profile_stage('pack_indicators', rows=self.row_count):
+                    self.pack_indicators()
+
+    def get_state_key(self, usecols, dtypes, skiprows, encoding):
+        """
+        Returns a digest of everything the saved tallies depend on 
+        besides the responses themselves
+        """
+        scales = sorted([sorted(q.get_variable_names()), 
+                         repr(q.get_scale().signature())] 
+                        for q in self.get_select_questions())
+        key = json.dumps([STATE_VERSION, usecols, 
+                          [dtypes.get(v) for v in usecols], list(skiprows),
+                          encoding, self.weight_variable, scales])
+        return(hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def get_file_checks(f, offset):
+        """
+        Returns hashes of the first STATE_CHECK_BYTES bytes of f before
+        offset and of the STATE_CHECK_BYTES bytes just before offset
+        """
+        checks = []
+        for start in [0, max(0, offset - STATE_CHECK_BYTES)]:
+            f.seek(start)
+            data = f.read(min(offset - start, STATE_CHECK_BYTES))
+            checks.append(hashlib.sha256(data).hexdigest())
+        return(checks)
+
+    def load_state(self, state_file, state_key, response_file):
+        """
+        Restores the tallies and row count saved by an earlier 
+        incremental load of response_file, if they still apply, and
+        returns the byte offset to resume reading from (0 to read the
+        whole file)
+        """
+        if not os.path.exists(state_file):
+            return(0)
+        try:
+            with open(state_file, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+                ImportError) as e:
+            print("Warning: Ignoring unreadable state file {}: {}".format(
+                  state_file, e))
+            return(0)
+        if state['key'] != state_key:
+            print("Warning: Codebook or options changed since {} was saved; "
+                  "reading all responses".format(state_file))
+            return(0)
+        offset = state['offset']
+        with open(response_file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if (size < offset or 
+                ResponseSet.get_file_checks(f, offset) != state['checks']):
+                print("Warning: {} was modified, not just appended to, "
+                      "since {} was saved; reading all responses".format(
+                      response_file, state_file))
+                return(0)
+        self.tallies = state['tallies']
+        self.row_count = state['row_count']
+        return(offset)
+
+    def save_state(self, state_file, state_key, f, offset):
+        """
+        Saves the tallies and row count, and the offset reached in the
+        open response file f, for the next incremental load
+        """
+        state = {'key': state_key, 'offset': offset, 
+                 'checks': ResponseSet.get_file_checks(f, offset),
+                 'row_count': self.row_count, 'tallies': self.tallies}
+        with atomic_write(state_file) as tmp:
+            with open(tmp, 'wb') as out:
+                pickle.dump(state, out, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def get_data_cache_file(cache_dir, response_file, usecols, dtypes,
+                            skiprows, encoding, categorical):
+        stat = os.stat(response_file)
+        key = json.dumps([DATA_CACHE_VERSION, os.path.abspath(response_file),
+                          stat.st_size, stat.st_mtime_ns, usecols,
+                          [dtypes.get(v) for v in usecols], list(skiprows),
+                          encoding, categorical])
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return(os.path.join(cache_dir, "responses_{}.feather".format(digest)))
+
+    @staticmethod
+    def load_cached_data(cache_file):
+        from pyarrow import feather
+        # memory_map only spares reading the file into Arrow buffers 
+        # before to_pandas copies it; the frame itself is loaded whole,
+        # since the counting code needs categorical and numpy columns
+        # rather than Arrow-backed ones
+        table = feather.read_table(cache_file, memory_map=True)
+        return(table.to_pandas())
+
+    @staticmethod
+    def save_cached_data(df, cache_file):
+        from pyarrow import feather
+        with atomic_write(cache_file) as tmp:
+            feather.write_feather(df, tmp, compression='uncompressed')
+
+    @property
+    def data(self):
+        """
+        The loaded responses (None when streaming). Assigning a new 
+        frame, such as a filtered self.data, resets the row count, the
+        weights, the cached tallies and the cut factorizations to match
+        it.
+        """
+        return(self._data)
+
+    @data.setter
+    def data(self, data):
+        if (self.packed and data is not None and 
+            not data.index.equals(self._data.index)):
+            raise(Exception("Rows cannot be changed once indicators are packed"))
+        self._data = data
+        if data is not None:
+            self.row_count = len(data)
+            self.weights = self.get_weights(data)
+        self.clear_tally_cache()
+
+    def encode_answers(self):
+        """
+        Converts each matched select one question's column to a 
+        Categorical over its scale values. Codes found in the data but
+        not on the scale become extra categories, so nothing is lost.
+        """
+        for q in self.get_select_questions():
+            if not isinstance(q, SelectOneQuestion):
+                continue
+            col = self.data[q.variable]
+            if isinstance(col.dtype, pd.CategoricalDtype):
+                continue
+            values = q.scale.get_values(False)
+            extra = sorted(set(col.dropna().unique().tolist()) - set(values))
+            self.data[q.variable] = pd.Categorical(col, 
+                                                   categories=values + extra)
+        self.clear_tally_cache()
+
+    def pack_indicators(self):
+        """
+        Moves each matched select multiple question's columns out of 
+        self.data into PackedIndicators
+        """
+        packed_vars = []
+        for q in self.get_select_questions():
+            if isinstance(q, SelectMultipleQuestion):
+                key = ResponseSet.tally_key(q)
+                self.packed[key] = PackedIndicators(self.data, q.variables)
+                packed_vars += q.variables
+        self.data = self.data.drop(columns=packed_vars)
+
+    def get_weights(self, df):
+        """
+        Returns the weight of each row of df, or None when unweighted
+        """
+        if self.weight_variable is None:
+            return(None)
+        return(row_weights(df, self.weight_variable))
+
+    def count_by_group(self, question, codes, n_groups, remove_exclusions=True,
+                       weights=None):
+        """
+        Returns question.count_by_group for the loaded data, using the
+        packed indicators for packed select multiple questions. Counts
+        are weighted by the ResponseSet's weights unless other weights
+        are given.
+        """
+        if weights is None:
+            weights = self.weights
+        packed = self.packed.get(ResponseSet.tally_key(question))
+        if packed is not None:
+            return(packed.count_by_group(
+                   question.get_tally_variables(remove_exclusions),
+                   codes, n_groups, weights))
+        return(question.count_by_group(self.data, codes, n_groups, 
+                                       remove_exclusions, weights))
+
+    def group_effective_sizes(self, question, codes, n_groups, 
+                              remove_exclusions=True):
+        """
+        Returns the effective sample size of question's respondents in
+        each group, or None when the ResponseSet is unweighted
+        """
+        if self.weights is None:
+            return(None)
+        cts = self.count_by_group(question, codes, n_groups, 
+                                  remove_exclusions)
+        sq = self.count_by_group(question, codes, n_groups, 
+                                 remove_exclusions, self.weights**2)
+        if isinstance(question, SelectMultipleQuestion):
+            return(effective_sizes(cts[1], sq[1]))
+        return(effective_sizes(cts.sum(axis=1), sq.sum(axis=1)))
+
+    def cooccurrence(self, question, remove_exclusions=True):
+        """
+        Returns a (choices x choices) array of respondents (or their 
+        weights) selecting both choices of a select multiple question
+        """
+        vars = question.get_tally_variables(remove_exclusions)
+        packed = self.packed.get(ResponseSet.tally_key(question))
+        if packed is not None:
+            if self.weights is None:
+                return(packed.cooccurrence(vars))
+            block = packed.unpack(vars)
+        else:
+            block = indicator_block(self.data, vars)
+        if self.weights is None:
+            block = block.astype(np.int64)
+            return(block.T.dot(block))
+        return(block.T.dot(block * self.weights[:, None]))
+
+    def __len__(self):
+        return(self.row_count)
+
+    def get_select_questions(self):
+        """
+        Returns the matched questions with matrix questions replaced by
+        their rows
+        """
+        return(select_questions(self.matched_questions))
+
+    @staticmethod
+    def tally_key(question):
+        return(frozenset(question.get_variable_names()))
+
+    def accumulate(self, df):
+        """
+        Adds the responses in df to the running tally of each question
+        """
+        weights = self.get_weights(df)
+        for q in self.get_select_questions():
+            key = ResponseSet.tally_key(q)
+            t = q.accumulate(df, weights)
+            if key in self.tallies:
+                t = self.tallies[key] + t
+            self.tallies[key] = t
+
+    def tally(self, question, remove_exclusions=True, rows=None):
+        """
+        Returns question's (frequencies, respondents, nonrespondents)
+        tuple, from the loaded data or from the streamed tallies. rows
+        optionally restricts the tally to a subset of self.data, such as
+        one group of a groupby.
+        """
+        summary = self.get_summary(question, rows)
+        return(question.tally_summary(summary, remove_exclusions))
+
+    def effective_sample_size(self, question, remove_exclusions=True, 
+                              rows=None):
+        """
+        Returns the Kish effective sample size of question's 
+        respondents, which is their number when unweighted
+        """
+        summary = self.get_summary(question, rows)
+        return(summary.effective_size(remove_exclusions))
+
+    def get_summary(self, question, rows=None):
+        """
+        Returns question's Tally, from the loaded data or from the 
+        streamed tallies
+        """
+        if self.data is None:
+            if rows is not None:
+                raise(Exception("Row subsets are not available when streaming"))
+            key = ResponseSet.tally_key(question)
+            if key not in self.tallies:
+                raise KeyError("No tally for question: {}".format(question.label))
+            summary = self.tallies[key]
+            if summary.signature != question.get_scale().signature():
+                raise(Exception("The choices or exclusions of {} changed "
+                                "after its responses were streamed; reload "
+                                "them to tally the new scale".format(
+                                question.label)))
+            return(summary)
+        return(self.get_cached_tally(question, rows))
+
+    def get_cached_tally(self, question, rows=None):
+        """
+        Returns the Tally of question over rows (default: all the data),
+        computing it only on first use. Cached tallies are keyed by the 
+        question's variables, its scale signature and the identity of 
+        the row subset, so changing a scale or its exclusions simply
+        misses the cache. A Tally covers both values of 
+        remove_exclusions.
+        """
+        packed = self.packed.get(ResponseSet.tally_key(question))
+        if packed is not None and rows is not None:
+            raise(Exception("Row subsets are not available for packed questions"))
+        if rows is None:
+            rows = self.data
+        # Tallies of all the data are keyed by None rather than the 
+        # frame's id, so they stay valid when the ResponseSet is pickled
+        subset = None if rows is self.data else id(rows)
+        key = (ResponseSet.tally_key(question), 
+               question.get_scale().signature(), subset)
+        if key not in self.tally_cache:
+            with profile_stage('tally', question.label, len(rows)):
+                self.tally_cache[key] = self.compute_tally(question, rows, 
+                                                           packed)
+            if rows is not self.data:
+                # drop the subset's tallies once the subset is collected,
+                # before its id can be reused
+                weakref.finalize(rows, self.forget_subset, subset)
+        return(self.tally_cache[key])
+
+    def get_cached_matrix_counts(self, question, remove_exclusions=True):
+        """
+        Returns the (rows x values) answer counts of a select one 
+        matrix question over all the data, counting the block of row
+        variables in one pass on first use. They are cached alongside
+        the tallies, keyed by the matrix's variables and scale
+        signature, so they are dropped with them.
+        """
+        scale = question.get_scale()
+        key = (('matrix', ResponseSet.tally_key(question), remove_exclusions),
+               scale.signature(), None)
+        if key not in self.tally_cache:
+            with profile_stage('tally', question.label, self.row_count):
+                self.tally_cache[key] = count_values_by_column(self.data,
+                    question.get_variable_names(), 
+                    scale.get_values(remove_exclusions), self.weights)
+        return(self.tally_cache[key])
+
+    def compute_tally(self, question, rows, packed=None):
+        weights = self.weights
+        if weights is not None and rows is not self.data:
+            weights = weights[self.data.index.get_indexer(rows.index)]
+        if packed is not None:
+            return(question.accumulate_packed(packed, weights))
+        return(question.accumulate(rows, weights))
+
+    def forget_subset(self, subset):
+        for key in [k for k in self.tally_cache if k[2] == subset]:
+            del self.tally_cache[key]
+
+    def clear_tally_cache(self):
+        """
+        Discards all memoized tallies and cut factorizations; call after
+        modifying self.data
+        """
+        self.tally_cache = {}
+        self.cut_cache = {}
+
+    @staticmethod
+    def get_column_dtypes(codebook):
+        """
+        Returns a dict mapping each codebook variable to the compact
+        integer dtype implied by its scale's value range. Variables
+        without coded values (e.g. select multiple indicators) are
+        treated as 0/1.
+        """
+        dtypes = {}
+        for q in codebook.get_questions():
+            scale = q.get_scale()
+            values = getattr(scale, 'values', None)
+            if not values:
+                values = [0, 1]
+            dtype = compact_int_dtype(min(values), max(values))
+            for v in q.get_variable_names():
+                dtypes[v] = dtype
+        return(dtypes)
+
+    @staticmethod
+    def convert_columns(df, dtypes, converted=None):
+        """
+        Converts the columns of df listed in dtypes to numbers and then
+        to their compact dtype. A column holding codes outside the
+        expected range is widened rather than truncated, and one holding
+        non-integer numbers is left as float.
+        """
+        if converted is None:
+            converted = set()
+        for v in df.columns:
+            if v not in dtypes:
+                continue
+            col = df[v]
+            if not pd.api.types.is_numeric_dtype(col):
+                if v not in converted:
+                    print("Converting variable {} to integer from {}".format(v, col.dtype))
+                    converted.add(v)
+                col = pd.to_numeric(col, errors='coerce')
+            df[v] = ResponseSet.compact_column(col, dtypes[v])
+        return(df)
+
+    @staticmethod
+    def compact_column(col, dtype):
+        values = col.to_numpy(dtype=float, na_value=np.nan)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return(col.astype(dtype))
+        if np.any(values != np.round(values)):
+            return(col.astype(float))
+        info = np.iinfo(dtype.lower())
+        lo, hi = values.min(), values.max()
+        if lo < info.min or hi > info.max:
+            dtype = compact_int_dtype(lo, hi)
+        return(col.astype(dtype))
+
+    def factorize_cut(self, cut_question, remove_exclusions=True):
+        """
+        Returns (codes, keys) for grouping the responses by a select one
+        question: keys lists the scale values that occur in the data and
+        codes gives each row's position in keys, or -1 for rows with no
+        (or an excluded) answer. Excluded answers are masked out rather
+        than removed from the data, and the result is cached per 
+        question, scale (including its exclusions) and remove_exclusions.
+        """
+        key = (cut_question.variable, cut_question.scale.signature(),
+               remove_exclusions)
+        if key not in self.cut_cache:
+            self.cut_cache[key] = self._factorize_cut(cut_question, 
+                                                      remove_exclusions)
+        return(self.cut_cache[key])
+
+    def _factorize_cut(self, cut_question, remove_exclusions):
+        values = cut_question.scale.get_values(remove_exclusions)
+        codes = value_codes(self.data[cut_question.variable], values)
+        present = np.bincount(codes[codes >= 0], minlength=len(values)) > 0
+        position = np.cumsum(present) - 1
+        codes = np.where(codes >= 0, position[codes], -1)
+        return(codes, [v for v, p in zip(values, present) if p])
+
+    def banner(self, questions, cut_questions, pct_format=".0%",
+               remove_exclusions=True, show_mean=True, mean_format=".1f"):
+        """
+        Cuts every question in questions by every select one question in
+        cut_questions (either may be given as codebook labels). Returns
+        one table per cut question, in order, with a row per question
+        and choice and a column per group, like 
+        SelectOneMatrixQuestion.cut_by.
+
+        Each cut variable is factorized once and each question's 
+        responses are coded once; every (question, cut) table is then a
+        single bincount, and the response data is never copied. The
+        counts for each cut are collected as arrays and formatted into 
+        one frame at the end, rather than a frame per question. Tables
+        are weighted when the ResponseSet is.
+        """
+        if self.data is None:
+            raise(Exception("Banner tables are not available when streaming"))
+        questions = [self.codebook.get_question(q) if isinstance(q, str) 
+                     else q for q in questions]
+        cuts = [self.codebook.get_question(q) if isinstance(q, str) else q
+                for q in cut_questions]
+        tables = build_banner(self, questions, cuts, remove_exclusions, 
+                              show_mean)
+        return([t.to_frame(pct_format, mean_format) for t in tables])
+
+    def group_counter(self, question, remove_exclusions=True):
+        """
+        Returns a function of (codes, n_groups) giving question's
+        count_by_group counts and group_effective_sizes for a cut, for 
+        build_banner. The question's responses are coded once, on this
+        call, and each cut is then a single bincount.
+        """
+        weights = self.weights
+        sq_weights = weights**2 if weights is not None else None
+        if isinstance(question, SelectOneQuestion):
+            values = question.scale.get_values(remove_exclusions)
+            answers = value_codes(self.data[question.variable], values)
+            def count(codes, n_groups):
+                cts = crosstab_codes(codes, answers, n_groups, len(values), 
+                                     weights)
+                if weights is None:
+                    return(cts, None)
+                sq = crosstab_codes(codes, answers, n_groups, len(values),
+                                    sq_weights)
+                return(cts, effective_sizes(cts.sum(axis=1), sq.sum(axis=1)))
+        elif ResponseSet.tally_key(question) in self.packed:
+            # packed questions are counted from their bits instead
+            def count(codes, n_groups):
+                return(self.count_by_group(question, codes, n_groups, 
+                                           remove_exclusions),
+                       self.group_effective_sizes(question, codes, n_groups,
+                                                  remove_exclusions))
+        else:
+            block = indicator_block(self.data, 
+                    question.get_tally_variables(remove_exclusions))
+            def count(codes, n_groups):
+                cts = count_indicators_by_group(block, codes, n_groups, 
+                                                weights)
+                if weights is None:
+                    return(cts, None)
+                sq = count_indicators_by_group(block, codes, n_groups, 
+                                               sq_weights)[1]
+                return(cts, effective_sizes(cts[1], sq))
+        return(count)
 
     def get_grouped_data(self, grouping_question):
-        groups = self.data.groupby(grouping_question.tag)
+        if self.data is None:
+            raise(Exception("Grouped data is not available when streaming"))
+        groups = self.data.groupby(grouping_question.variable)
         return(groups)
-        
+
+    def set_weights(self, weights, weight_variable="weight"):
+        """
+        Stores weights (one per row) in self.data as weight_variable and
+        weights every later tally, cut and banner by it
+        """
+        if self.data is None:
+            raise(Exception("Weights cannot be set when streaming"))
+        self.data[weight_variable] = row_weights(self.data, weights)
+        self.weight_variable = weight_variable
+        self.weights = self.get_weights(self.data)
+        self.clear_tally_cache()
+
+    def rake(self, targets, tol=1e-6, max_iter=100, trim=None, 
+             weight_variable="rake_weight"):
+        """
+        Computes raked (RIM) weights matching target marginals and sets
+        them as the ResponseSet's weights. targets maps select one 
+        questions (or their codebook labels) to a dict of target shares
+        keyed by scale value or choice text; every answer given to a 
+        raked question needs a target. Any weights already set are used
+        as base weights. Respondents who did not answer a question are 
+        left out of its adjustment. See raking.rake_codes for tol,
+        max_iter and trim.
+
+        Returns the weights.
+        """
+        if self.data is None:
+            raise(Exception("Raking is not available when streaming"))
+        codes = []
+        shares = []
+        for q, target in targets.items():
+            if isinstance(q, str):
+                q = self.codebook.get_question(q)
+            if not isinstance(q, SelectOneQuestion):
+                raise(Exception("Can only rake on a SelectOneQuestion type"))
+            choice_values = dict(zip(q.scale.choices, q.scale.values))
+            values = [choice_values.get(k, k) for k in target.keys()]
+            col = self.data[q.variable]
+            codes.append(value_codes(col, values))
+            if (codes[-1] < 0).sum() > col.isna().sum():
+                raise(Exception("Every answer to {} needs a target".format(
+                                q.label)))
+            shares.append(list(target.values()))
+        with profile_stage('rake', rows=len(self.data)):
+            weights, iterations, converged = rake_codes(codes, shares, 
+                self.weights, tol, max_iter, trim)
+        if not converged:
+            print("Warning: Raking did not converge in {} iterations".format(
+                  iterations))
+        self.set_weights(weights, weight_variable)
+        return(weights)
+
@@ -22,6 +22,14 @@ class QuestionScale():
         return (self.choices == other.choices and 
                 self.exclude_from_analysis == other.exclude_from_analysis)
 
+    def signature(self):
+        """
+        Returns a hashable summary of the scale which changes whenever
+        its choices or exclusions do
+        """
+        return((type(self).__name__, tuple(self.choices),
+                tuple(self.exclude_from_analysis)))
+
     @staticmethod
     def change_scale(oldscale, new_type, new_values=None, new_midpoint=None):
         if hasattr(oldscale, 'values') and new_values==None:
@@ -37,7 +45,7 @@ class QuestionScale():
         self.exclude_from_analysis.reverse()
 
     def get_choices(self, remove_exclusions=True):
-        choices = self.choices
+        choices = list(self.choices)
         if remove_exclusions:
             choices = list(compress(choices, 
                       [not x for x in self.exclude_from_analysis]))
@@ -75,12 +83,15 @@ class OrdinalScale(QuestionScale):
         else:
             return(False)
 
+    def signature(self):
+        return(super().signature() + (tuple(self.values),))
+
     def reverse_choices(self):
         super().reverse_choices()
         self.values.reverse()
 
     def get_values(self, remove_exclusions=True):
-        values = self.values
+        values = list(self.values)
         if remove_exclusions:
             values = list(compress(values, 
                       [not x for x in self.exclude_from_analysis]))
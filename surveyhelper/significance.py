@@ -0,0 +1,90 @@
+"""
+Significance
+------------
+Significance tests computed from group sufficient statistics rather
+than from unit records. Every function works along the last axis
+(groups) and broadcasts over any leading axes, so a whole banner of
+questions or choices is tested in one batch of array operations.
+"""
+
+import numpy as np
+
+# scipy.stats is imported inside the tests rather than here, as it takes
+# far longer to import than the rest of the package
+
+def welch_t_test(n, s, ss):
+    """
+    Returns two-sided p-values of Welch's unequal variances t-test for
+    groups of size n with value sums s and sums of squares ss. The last
+    axis must have length 2.
+    """
+    from scipy.stats import t as t_dist
+    n, s, ss = [np.asarray(x, dtype=float) for x in (n, s, ss)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = s / n
+        var = (ss - s * mean) / (n - 1)
+        se2 = var / n
+        tstat = (mean[..., 0] - mean[..., 1]) / np.sqrt(se2.sum(axis=-1))
+        df = se2.sum(axis=-1)**2 / (se2**2 / (n - 1)).sum(axis=-1)
+        return(2 * t_dist.sf(np.abs(tstat), df))
+
+def one_way_anova(n, s, ss):
+    """
+    Returns p-values of the one-way ANOVA F test across groups of size n
+    with value sums s and sums of squares ss. Empty groups are ignored.
+    """
+    from scipy.stats import f as f_dist
+    n, s, ss = [np.asarray(x, dtype=float) for x in (n, s, ss)]
+    k = (n > 0).sum(axis=-1)
+    total = n.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        group_ss = np.where(n > 0, s**2 / n, 0)
+        between = group_ss.sum(axis=-1) - s.sum(axis=-1)**2 / total
+        within = ss.sum(axis=-1) - group_ss.sum(axis=-1)
+        fstat = (between / (k - 1)) / (within / (total - k))
+        return(f_dist.sf(fstat, k - 1, total - k))
+
+def compare_means(n, s, ss):
+    """
+    Returns p-values for a difference in means across groups, using
+    Welch's t-test for two groups and one-way ANOVA for more. Fewer
+    than two groups gives nan.
+    """
+    n = np.asarray(n)
+    groups = n.shape[-1]
+    if groups == 2:
+        return(welch_t_test(n, s, ss))
+    elif groups > 2:
+        return(one_way_anova(n, s, ss))
+    else:
+        return(np.full(n.shape[:-1], np.nan))
+
+def chisquare_by_choice(counts, respondents):
+    """
+    For select multiple questions: tests, separately for each choice,
+    whether the share of respondents picking it differs across groups.
+    counts is (..., groups, choices), respondents is (..., groups).
+    Returns p-values shaped (..., choices).
+    """
+    from scipy.stats import chi2
+    counts = np.asarray(counts, dtype=float)
+    respondents = np.asarray(respondents, dtype=float)
+    groups = counts.shape[-2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = counts.sum(axis=-2) / respondents.sum(axis=-1)[..., None]
+        expected = share[..., None, :] * respondents[..., :, None]
+        stat = ((counts - expected)**2 / expected).sum(axis=-2)
+        return(chi2.sf(stat, groups - 1))
+
+def scale_to_effective_size(counts, totals, effective_n):
+    """
+    Rescales weighted counts so each group's total equals its effective
+    sample size, so that tests treating counts as unit records are not
+    overstated by the weights (a Kish design effect adjustment). counts
+    is (..., groups, choices); totals and effective_n are (..., groups).
+    """
+    counts = np.asarray(counts, dtype=float)
+    totals = np.asarray(totals, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factor = np.where(totals > 0, effective_n / totals, 0.0)
+    return(counts * factor[..., None])
@@ -0,0 +1,286 @@
+"""
+Tally
+-----
+Array-level counting routines shared by the question types. Each
+function works on a whole block of response columns at once rather
+than row by row.
+"""
+
+import numpy as np
+import pandas as pd
+
+class Tally:
+    """
+    Additive summary of one select question's responses: a count for
+    each key (an answer value, or an indicator variable for select
+    multiple questions), the number of respondents with and without
+    excluded choices, and the number of rows seen. Tallies over
+    disjoint sets of rows combine with +.
+
+    A weighted Tally holds sums of weights in place of counts, and
+    sumsq holds the sum of squared weights of the respondents, from
+    which effective_size gives the Kish effective sample size. For an
+    unweighted Tally sumsq is simply the number of respondents.
+
+    signature is the question's scale signature when the Tally was
+    accumulated. The respondents excluding excluded choices depend on
+    it, so a Tally cannot be used once the scale's exclusions change.
+    """
+
+    def __init__(self, keys, counts, respondents, rows, sumsq=None,
+                 signature=None):
+        self.keys = list(keys)
+        self.counts = np.asarray(counts)
+        # {remove_exclusions: number (or weight) of respondents}
+        self.respondents = respondents
+        self.rows = rows
+        if sumsq is None:
+            sumsq = dict(respondents)
+        # {remove_exclusions: sum of squared weights of respondents}
+        self.sumsq = sumsq
+        self.signature = signature
+
+    def __add__(self, other):
+        if self.keys != other.keys:
+            raise(Exception("Cannot combine tallies with different keys"))
+        if self.signature != other.signature:
+            raise(Exception("Cannot combine tallies of different scales"))
+        respondents = dict((k, v + other.respondents[k]) 
+                           for k, v in self.respondents.items())
+        sumsq = dict((k, v + other.sumsq[k]) for k, v in self.sumsq.items())
+        return(Tally(self.keys, self.counts + other.counts, respondents,
+                     self.rows + other.rows, sumsq, self.signature))
+
+    def get_counts(self, keys):
+        """
+        Returns the counts for keys, in that order
+        """
+        position = dict((k, i) for i, k in enumerate(self.keys))
+        return([self.counts[position[k]].item() for k in keys])
+
+    def moments(self, values):
+        """
+        Returns (n, sum, sum of squares) of the answers, treating each
+        key in values as a numeric answer value
+        """
+        return(count_moments(self.get_counts(values), values))
+
+    def effective_size(self, remove_exclusions=True):
+        """
+        Returns the Kish effective sample size of the respondents,
+        (sum of weights)^2 / (sum of squared weights)
+        """
+        return(effective_sizes(self.respondents[remove_exclusions],
+                               self.sumsq[remove_exclusions]).item())
+
+def effective_sizes(totals, sumsq):
+    """
+    Returns the Kish effective sample size for each pair of weight
+    total and sum of squared weights, with 0 where there are none
+    """
+    totals = np.asarray(totals, dtype=float)
+    sumsq = np.asarray(sumsq, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return(np.where(sumsq > 0, totals**2 / sumsq, 0.0))
+
+def row_weights(df, weights):
+    """
+    Returns the weight of each row of df as a float array, or None for
+    unweighted data. weights is None, the name of a weight column in 
+    df, or an array of weights in row order. Missing weights are 0, so
+    those rows drop out of every weighted total; weights that are 
+    present but not numbers raise an exception.
+    """
+    if weights is None:
+        return(None)
+    if isinstance(weights, str):
+        weights = df[weights]
+    weights = pd.Series(np.asarray(weights))
+    numeric = pd.to_numeric(weights, errors='coerce')
+    invalid = numeric.isna() & weights.notna()
+    if invalid.any():
+        raise(Exception("Found {} weights that are not numbers, such as "
+                        "{!r}".format(invalid.sum(), 
+                                      weights[invalid].iloc[0])))
+    weights = numeric.to_numpy(dtype=float, na_value=np.nan)
+    if len(weights) != len(df):
+        raise(Exception("Expected {} weights, got {}".format(len(df), 
+                                                            len(weights))))
+    weights = np.nan_to_num(weights, nan=0.0)
+    if np.any(weights < 0):
+        raise(Exception("Weights must not be negative"))
+    return(weights)
+
+def group_codes(groupby):
+    """
+    Returns (codes, keys) for a pandas groupby object, where codes is an
+    integer array giving each row's group position (-1 for rows whose
+    key is missing) and keys lists the group keys in that same order.
+    """
+    codes = groupby.ngroup()
+    codes = codes.fillna(-1).to_numpy(dtype=np.int64)
+    keys = groupby.size().index.tolist()
+    return(codes, keys)
+
+def indicator_block(df, variables):
+    """
+    Returns a boolean matrix (rows x variables) which is True wherever a
+    response was recorded.
+    """
+    return(df[variables].notna().to_numpy())
+
+def count_indicators_by_group(block, codes, n_groups, weights=None):
+    """
+    Counts a boolean indicator block within each group. Returns
+    (counts, respondents) where counts is an (n_groups x columns) array
+    of rows answering each column and respondents is the number of rows
+    in each group answering at least one column. Rows with a negative
+    group code are ignored. With weights, each row counts its weight.
+    """
+    keep = codes >= 0
+    block = block[keep]
+    codes = codes[keep]
+    if weights is None:
+        dtype = np.int64
+        w = 1
+    else:
+        dtype = float
+        w = weights[keep]
+    counts = np.zeros((n_groups, block.shape[1]), dtype=dtype)
+    for j in range(block.shape[1]):
+        counts[:, j] = np.bincount(codes, weights=block[:, j] * w,
+                                   minlength=n_groups)
+    respondents = np.bincount(codes, weights=block.any(axis=1) * w,
+                              minlength=n_groups).astype(dtype)
+    return(counts, respondents)
+
+def value_codes(series, values):
+    """
+    Maps each response in series to its position in values, with -1 for
+    missing responses and codes that are not in values. A categorical
+    series is mapped through its categories, so only the small category
+    list is looked up and the rows are a single integer take.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        lookup = pd.Index(values).get_indexer(series.cat.categories)
+        # a missing response has code -1, which picks the appended -1
+        lookup = np.append(lookup, -1)
+        return(lookup[series.cat.codes.to_numpy()])
+    return(pd.Index(values).get_indexer(series))
+
+def crosstab_codes(row_codes, col_codes, n_rows, n_cols, weights=None):
+    """
+    Returns an (n_rows x n_cols) array counting each (row, col) code
+    pair, or summing their weights. Pairs where either code is negative
+    are ignored.
+    """
+    keep = (row_codes >= 0) & (col_codes >= 0)
+    flat = row_codes[keep] * n_cols + col_codes[keep]
+    if weights is not None:
+        weights = weights[keep]
+    counts = np.bincount(flat, weights=weights, minlength=n_rows * n_cols)
+    return(counts.reshape(n_rows, n_cols))
+
+def count_values_by_column(df, variables, values, weights=None):
+    """
+    Returns a (variables x values) array counting how often each value
+    appears in each column of df[variables], or summing the weights of
+    those rows. Missing responses and codes that are not in values are
+    ignored.
+    """
+    codes = np.column_stack([value_codes(df[v], values) for v in variables])
+    columns = np.broadcast_to(np.arange(len(variables)), codes.shape)
+    if weights is not None:
+        weights = np.repeat(weights, len(variables))
+    return(crosstab_codes(columns.ravel(), codes.ravel(), len(variables),
+                          len(values), weights))
+
+def count_moments(counts, values):
+    """
+    Returns (n, sum, sum of squares) along the last axis of an array of
+    answer counts, where values gives the numeric value of each column
+    """
+    counts = np.asarray(counts, dtype=float)
+    x = np.asarray(values, dtype=float)
+    return((counts.sum(axis=-1), counts.dot(x), counts.dot(x*x)))
+
+# Number of set bits in each possible byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+class PackedIndicators:
+    """
+    Bit-packed storage for select multiple indicator columns: one bit
+    per row for each variable, set where a response was recorded. Each
+    variable's column is packed along the rows, so counts, respondent
+    totals, co-occurrences and group cuts are bitwise ANDs/ORs followed
+    by a popcount, at one eighth of a byte per row.
+    """
+
+    def __init__(self, df, variables):
+        self.variables = list(variables)
+        self.position = dict((v, i) for i, v in enumerate(self.variables))
+        self.rows = len(df)
+        self.bits = np.packbits(indicator_block(df, self.variables), axis=0)
+
+    def columns(self, variables):
+        return(self.bits[:, [self.position[v] for v in variables]])
+
+    def unpack(self, variables):
+        """
+        Returns the boolean (rows x variables) indicator block, for
+        weighted totals that cannot be taken from a popcount
+        """
+        return(np.unpackbits(self.columns(variables), axis=0, 
+                             count=self.rows).astype(bool))
+
+    def any_bits(self, variables):
+        """
+        Returns the packed rows answering at least one of variables
+        """
+        cols = self.columns(variables)
+        if cols.shape[1] == 0:
+            return(np.zeros(len(cols), dtype=np.uint8))
+        return(np.bitwise_or.reduce(cols, axis=1))
+
+    def counts(self, variables):
+        """
+        Returns the number of rows answering each of variables
+        """
+        return(POPCOUNT[self.columns(variables)].sum(axis=0, dtype=np.int64))
+
+    def respondents(self, variables):
+        """
+        Returns the number of rows answering at least one of variables
+        """
+        return(int(POPCOUNT[self.any_bits(variables)].sum(dtype=np.int64)))
+
+    def cooccurrence(self, variables):
+        """
+        Returns a (variables x variables) array counting the rows that
+        answered both variables; the diagonal holds the counts
+        """
+        cols = self.columns(variables)
+        out = np.zeros((len(variables), len(variables)), dtype=np.int64)
+        for i in range(len(variables)):
+            out[i] = POPCOUNT[cols[:, i:i+1] & cols].sum(axis=0, 
+                                                           dtype=np.int64)
+        return(out)
+
+    def count_by_group(self, variables, codes, n_groups, weights=None):
+        """
+        Packed equivalent of count_indicators_by_group, given each row's
+        group code (-1 for rows in no group)
+        """
+        if weights is not None:
+            return(count_indicators_by_group(self.unpack(variables), codes,
+                                             n_groups, weights))
+        cols = self.columns(variables)
+        answered = self.any_bits(variables)
+        counts = np.zeros((n_groups, cols.shape[1]), dtype=np.int64)
+        respondents = np.zeros(n_groups, dtype=np.int64)
+        for g in range(n_groups):
+            mask = np.packbits(codes == g)
+            counts[g] = POPCOUNT[cols & mask[:, None]].sum(axis=0, 
+                                                           dtype=np.int64)
+            respondents[g] = POPCOUNT[answered & mask].sum(dtype=np.int64)
+        return(counts, respondents)